@@ -0,0 +1,218 @@
+#!/usr/bin/python3
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: nil; tab-width: 4 -*-
+#   Mugshot - Lightweight user configuration utility
+#   Copyright (C) 2013-2019 Sean Davis <sean@bluesabre.org>
+#
+#   Portions of this file are adapted from web_cam_box,
+#   Copyright (C) 2010 Rick Spencer <rick.spencer@canonical.com>
+#
+#   This program is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful, but
+#   WITHOUT ANY WARRANTY; without even the implied warranties of
+#   MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+#   PURPOSE.  See the GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Camera backend code shared by the Cheese and GStreamer camera boxes.
+
+A camera box is a widget showing the live preview. It emits photo-saved
+with an ImageHandle when a photo is ready, and gst-state-changed with the
+Gst.State of its pipeline."""
+
+import logging
+import threading
+import time
+
+from gi.repository import GObject, GLib  # pylint: disable=E0611
+
+from mugshot_lib import imaging
+
+logger = logging.getLogger('mugshot')
+
+# Preview and capture resolutions used if the settings cannot be parsed.
+default_preview_resolution = (640, 480)
+default_capture_resolution = (1280, 720)
+
+# After switching to the capture mode the camera needs a moment to adjust
+# its exposure and white balance, so the first frames are not used.
+settle_frames = 5
+settle_time = 300  # milliseconds, for backends without frame access
+
+
+def get_camera_box_signals():
+    """Return the __gsignals__ of a camera box."""
+    return {
+        'photo-saved': (GObject.SIGNAL_RUN_LAST,
+                        GObject.TYPE_NONE,
+                        (GObject.TYPE_PYOBJECT,)),
+        'gst-state-changed': (GObject.SIGNAL_RUN_LAST,
+                              GObject.TYPE_NONE,
+                              (GObject.TYPE_INT,))
+    }
+
+
+def parse_resolution(value):
+    """Return the (width, height) of a WIDTHxHEIGHT string, or None."""
+    try:
+        width, height = value.lower().split('x')
+        return (int(width), int(height))
+    except ValueError:
+        return None
+
+
+def choose_video_mode(modes, resolution):
+    """Return the smallest of the (width, height, jpeg, ...) modes covering
+    resolution, preferring MJPEG between modes of the same size, or the
+    largest mode if none is big enough."""
+    if len(modes) == 0:
+        return None
+    width, height = resolution
+    covering = [mode for mode in modes
+                if mode[0] >= width and mode[1] >= height]
+    if len(covering) > 0:
+        return min(covering, key=lambda mode: (mode[0] * mode[1],
+                                                not mode[2]))
+    return max(modes, key=lambda mode: (mode[0] * mode[1], mode[2]))
+
+
+class CameraCapture:
+
+    """Mixin turning the frames captured by a camera box into a photo.
+
+    Backends call start_capture() when a photo is requested and
+    add_burst_frame() for every frame captured. The sharpest frame of the
+    burst is cropped and encoded in a worker thread, then photo-saved is
+    emitted on the main loop."""
+
+    def init_capture(self, settings):
+        self.settings = settings
+
+        # Start time, encoding options and frames of the pending capture.
+        self.capture_time = None
+        self.encode_options = None
+        self.burst = None
+        self.burst_size = 1
+
+        # Start time and label of the pending time-to-first-frame metric,
+        # and a function disconnecting its handler.
+        self.frame_timer = None
+        self.frame_disconnect = None
+
+    def get_resolution_setting(self, key, default):
+        """Return the (width, height) stored in a resolution setting."""
+        value = self.settings.get_string(key)
+        resolution = parse_resolution(value)
+        if resolution is None:
+            logger.warning('Invalid %s "%s", using %ix%i' %
+                           ((key, value) + default))
+            return default
+        return resolution
+
+    def get_video_mode_settings(self, modes):
+        """Return the (preview, capture) modes chosen from modes."""
+        preview_mode = choose_video_mode(
+            modes, self.get_resolution_setting('camera-preview-resolution',
+                                               default_preview_resolution))
+        capture_mode = choose_video_mode(
+            modes, self.get_resolution_setting('camera-capture-resolution',
+                                               default_capture_resolution))
+        for label, mode in [('preview', preview_mode),
+                            ('capture', capture_mode)]:
+            if mode is not None:
+                logger.debug('Camera %s mode: %ix%i%s' %
+                             (label, mode[0], mode[1],
+                              ' (MJPEG)' if mode[2] else ''))
+        return preview_mode, capture_mode
+
+    def start_capture(self):
+        """Start collecting the frames of a new photo."""
+        self.capture_time = time.monotonic()
+        self.encode_options = (self.settings.get_int('avatar-max-size'),
+                               self.settings.get_string('avatar-format'),
+                               self.settings.get_int('avatar-compression'),
+                               self.settings.get_int('avatar-quality'))
+        self.burst = []
+        self.burst_size = self.settings.get_int('camera-burst-frames')
+        if imaging.numpy is None:
+            # Frames cannot be scored, so keep the first one.
+            self.burst_size = 1
+
+    def cancel_capture(self):
+        """Drop the pending photo."""
+        self.capture_time = None
+        self.burst = None
+
+    def add_burst_frame(self, pixbuf):
+        """Add a captured frame to the burst. Return True if more frames are
+        needed, otherwise start processing the photo."""
+        if self.burst is None:
+            return False
+        self.burst.append(pixbuf)
+        if len(self.burst) < self.burst_size:
+            return True
+
+        thread = threading.Thread(target=self.process_photo,
+                                  args=(self.burst, self.capture_time,
+                                        self.encode_options))
+        thread.daemon = True
+        thread.start()
+        self.burst = None
+        return False
+
+    def process_photo(self, pixbufs, capture_time, encode_options):
+        """Worker thread: keep the sharpest frame of the burst, crop it and
+        encode it with the profile image settings, so applying it does not
+        have to."""
+        # Create a new pixbuf cropped to a balanced center.
+        crop = imaging.get_crop_rectangle(pixbufs[0].get_width(),
+                                          pixbufs[0].get_height(),
+                                          imaging.CROP_CENTER)
+        start = time.monotonic()
+        pixbuf = imaging.get_sharpest_pixbuf(pixbufs, crop)
+        if len(pixbufs) > 1:
+            logger.debug('Scored %i frames in %.1f ms' %
+                         (len(pixbufs), (time.monotonic() - start) * 1000))
+        # Copy the crop so the full frames are released.
+        new_pixbuf = imaging.crop_pixbuf(pixbuf, crop).copy()
+
+        image = imaging.ImageHandle(pixbuf=new_pixbuf)
+        image.get_data(*encode_options)
+        GLib.idle_add(self.on_photo_processed, image, capture_time)
+
+    def on_photo_processed(self, image, capture_time):
+        """Emit photo-saved on the main loop once the photo is ready."""
+        if capture_time != self.capture_time:
+            # A newer capture was started, drop this one.
+            return False
+        logger.debug('Photo ready %.1f ms after capture' %
+                     ((time.monotonic() - capture_time) * 1000))
+        self.capture_time = None
+        self.emit("photo-saved", image)
+        return False
+
+    def set_frame_timer(self, start_time, label, disconnect):
+        """Remember the start of a time-to-first-frame measurement."""
+        self.stop_frame_timer()
+        self.frame_timer = (start_time, label)
+        self.frame_disconnect = disconnect
+
+    def stop_frame_timer(self):
+        if self.frame_disconnect is not None:
+            self.frame_disconnect()
+            self.frame_disconnect = None
+        self.frame_timer = None
+
+    def on_first_frame(self, *args):
+        if self.frame_timer is None:
+            return
+        start_time, label = self.frame_timer
+        logger.debug('First camera frame %.1f ms after show (%s start, %s)' %
+                     ((time.monotonic() - start_time) * 1000, label,
+                      self.backend))
+        self.stop_frame_timer()
@@ -19,18 +19,15 @@
 #   You should have received a copy of the GNU General Public License along
 #   with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import os
 import logging
+import time
 
 from locale import gettext as _
 
 import gi
 gi.require_version('Gst', '1.0')
-gi.require_version('Cheese', '3.0')
-gi.require_version('GtkClutter', '1.0')
 
-from gi.repository import Gtk, GObject, Gst  # nopep8
-from gi.repository import Cheese, Clutter, GtkClutter  # nopep8
+from gi.repository import Gtk, GObject, GLib, Gio, Gst  # nopep8
 
 from mugshot_lib import helpers  # nopep8
 from mugshot_lib.CameraDialog import CameraDialog  # nopep8
@@ -38,148 +35,45 @@ from mugshot_lib.CameraDialog import CameraDialog  # nopep8
 logger = logging.getLogger('mugshot')
 
 
-class CameraBox(GtkClutter.Embed):
-    __gsignals__ = {
-        'photo-saved': (GObject.SIGNAL_RUN_LAST,
-                        GObject.TYPE_NONE,
-                        (GObject.TYPE_STRING,)),
-        'gst-state-changed': (GObject.SIGNAL_RUN_LAST,
-                              GObject.TYPE_NONE,
-                              (GObject.TYPE_INT,))
-    }
-
-    def __init__(self, parent):
-        GtkClutter.Embed.__init__(self)
-        self.state = Gst.State.NULL
-        self.parent = parent
-
-        video_texture = self.setup_ui()
-
-        self.camera = Cheese.Camera.new(video_texture,
-                                        "Mugshot", 1280, 720)
-        Cheese.Camera.setup(self.camera, None)
-        Cheese.Camera.play(self.camera)
-        self.state = Gst.State.PLAYING
-
-        def added(signal, data):
-            if "get_device_node" in dir(data):
-                node = data.get_device_node()
-                self.camera.set_device_by_device_node(node)
-            else:
-                self.camera.set_device(data)
-            self.camera.switch_camera_device()
-
-        device_monitor = Cheese.CameraDeviceMonitor.new()
-        device_monitor.connect("added", added)
-        device_monitor.coldplug()
-
-        self.camera.connect("photo-taken", self.on_photo_taken)
-        self.camera.connect("state-flags-changed", self.on_state_flags_changed)
-
-        self._save_filename = ""
-
-    def setup_ui(self):
-        viewport = self.get_stage()
-
-        video_preview = Clutter.Actor.new()
-        video_preview.set_content_gravity(Clutter.ContentGravity.RESIZE_ASPECT)
-        video_preview.set_x_expand(True)
-        video_preview.set_y_expand(True)
-        video_preview.props.min_height = 100.0
-        video_preview.props.min_width = 100.0
-        video_texture = video_preview
-
-        viewport_layout = Clutter.Actor.new()
-        viewport_layout.add_child(video_preview)
-
-        viewport_layout_manager = Clutter.BinLayout()
-
-        background_layer = Clutter.Actor.new()
-        background_layer.props.background_color = \
-            Clutter.Color.from_string("Black")[1]
-        background_layer.props.x = 0
-        background_layer.props.y = 0
-        background_layer.props.width = 100
-        background_layer.props.height = 100
-
-        video_preview.props.request_mode = Clutter.RequestMode.HEIGHT_FOR_WIDTH
-
-        viewport.add_child(background_layer)
-
-        viewport_layout.set_layout_manager(viewport_layout_manager)
-
-        viewport.add_child(viewport_layout)
-
-        viewport.connect("allocation_changed", self.on_stage_resize,
-                         viewport_layout, background_layer)
-
-        return video_texture
-
-    def on_stage_resize(self, actor, box, flags, layout, background):
-        s_width, s_height = self.get_stage().get_size()
-
-        v_width = self.camera.props.format.width
-        v_height = self.camera.props.format.height
-
-        square = min(s_width, s_height)
-        if v_width > v_height:
-            scale = square / v_height
-            v_height = square
-            v_width = v_width * scale
-        else:
-            scale = square / v_width
-            v_height = v_height * scale
-            v_width = square
-
-        x_adj, y_adj = (s_width - v_width) / 2.0, (s_height - v_height) / 2.0
-
-        layout.set_size(v_width, v_height)
-        layout.set_x(x_adj)
-        layout.set_y(y_adj)
-
-        background.set_size(s_width, s_height)
-
-    def on_state_flags_changed(self, camera, state):
-        self.state = state
-        self.emit("gst-state-changed", self.state)
-
-    def play(self):
-        if self.state != Gst.State.PLAYING:
-            Cheese.Camera.play(self.camera)
-
-    def pause(self):
-        if self.state == Gst.State.PLAYING:
-            Cheese.Camera.play(self.camera)
-
-    def stop(self):
-        Cheese.Camera.stop(self.camera)
-
-    def take_photo(self, target_filename):
-        self._save_filename = target_filename
-        return self.camera.take_photo_pixbuf()
-
-    def on_photo_taken(self, camera, pixbuf):
-        # Get the image dimensions.
-        height = pixbuf.get_height()
-        width = pixbuf.get_width()
-        start_x = 0
-        start_y = 0
-
-        # Calculate a balanced center.
-        if width > height:
-            start_x = (width - height) / 2
-            width = height
-        else:
-            start_y = (height - width) / 2
-            height = width
-
-        # Create a new cropped pixbuf.
-        new_pixbuf = pixbuf.new_subpixbuf(start_x, start_y, width, height)
-
-        # Overwrite the temporary file with our new cropped image.
-        new_pixbuf.savev(self._save_filename, "png", [], [])
-
-        self.emit("photo-saved", self._save_filename)
+def get_cheese_camera_box():
+    """Return the Cheese camera box class, or None if it is unavailable."""
+    try:
+        from mugshot.CheeseCameraBox import CheeseCameraBox, \
+            has_cheese_backend_support
+    except (ImportError, ValueError):
+        return None
+    if not has_cheese_backend_support():
+        return None
+    return CheeseCameraBox
+
+
+def get_gstreamer_camera_box():
+    """Return the GStreamer camera box class, or None if it is
+    unavailable."""
+    try:
+        from mugshot.GstCameraBox import GstCameraBox, \
+            has_gstreamer_backend_support
+    except (ImportError, ValueError):
+        return None
+    if not has_gstreamer_backend_support():
+        return None
+    return GstCameraBox
+
+
+def get_camera_box_class(backend='auto'):
+    """Return the camera box class for the camera-backend setting. Cheese is
+    preferred unless the GStreamer backend is selected, and each backend
+    falls back to the other one. Backends are only imported when used."""
+    if backend == 'gstreamer':
+        loaders = [get_gstreamer_camera_box, get_cheese_camera_box]
+    else:
+        loaders = [get_cheese_camera_box, get_gstreamer_camera_box]
+    for loader in loaders:
+        camera_box = loader()
+        if camera_box is not None:
+            logger.debug('Using the %s camera backend' % camera_box.backend)
+            return camera_box
+    return None
 
 
 class CameraMugshotDialog(CameraDialog):
@@ -188,66 +82,133 @@ class CameraMugshotDialog(CameraDialog):
     __gtype_name__ = "CameraMugshotDialog"
     __gsignals__ = {'apply': (GObject.SIGNAL_RUN_LAST,
                               GObject.TYPE_NONE,
-                              (GObject.TYPE_STRING,))
+                              (GObject.TYPE_PYOBJECT,))
                    }
 
     def finish_initializing(self, builder):  # pylint: disable=E1002
         """Set up the camera dialog"""
         super(CameraMugshotDialog, self).finish_initializing(builder)
+        self.start_time = time.monotonic()
+        self.prewarming = False
 
         # Initialize Gst or nothing will work.
         Gst.init(None)
-        Clutter.init(None)
 
-        self.camera = CameraBox(self)
+        self.settings = Gio.Settings.new("apps.mugshot")
+
+        # Essential widgets
+        self.record_button = builder.get_object('camera_record')
+        self.apply_button = builder.get_object('camera_apply')
+
+        # Store the ImageHandle of the captured photo.
+        self.image = None
+
+        # Timeout releasing the camera after the dialog is hidden.
+        self.release_source = None
+
+        vbox = builder.get_object('camera_box')
+        camera_box = get_camera_box_class(
+            self.settings.get_string('camera-backend'))
+        if camera_box is None:
+            # The elements or libraries used by every backend are missing.
+            logger.warning('No camera backend is available.')
+            self.camera = None
+            label = Gtk.Label.new(_("No camera backend is available."))
+            label.show()
+            vbox.pack_start(label, True, True, 0)
+            self.record_button.set_sensitive(False)
+            return
+
+        self.camera = camera_box(self, self.settings)
         self.camera.show()
 
         self.camera.connect("gst-state-changed", self.on_camera_state_changed)
         self.camera.connect("photo-saved", self.on_camera_photo_saved)
 
         # Pack the video widget into the dialog.
-        vbox = builder.get_object('camera_box')
         vbox.pack_start(self.camera, True, True, 0)
 
-        # Essential widgets
-        self.record_button = builder.get_object('camera_record')
-        self.apply_button = builder.get_object('camera_apply')
-
-        # Store the temporary filename to be used.
-        self.filename = None
-
-        self.show_all()
+        # Offer a device picker when there is more than one camera.
+        self.device_combo = Gtk.ComboBoxText.new()
+        self.device_combo.set_no_show_all(True)
+        self.device_combo.set_margin_top(6)
+        vbox.pack_start(self.device_combo, False, False, 0)
+        self.update_device_combo()
+        self.device_combo.connect("changed", self.on_device_combo_changed)
+
+    def update_device_combo(self):
+        """List the capture devices in the device picker."""
+        self.device_combo.remove_all()
+        devices = helpers.get_video_devices()
+        for node, name in devices:
+            self.device_combo.append(node, "%s (%s)" % (name, node))
+        self.device_combo.set_active_id(self.camera.get_device_node())
+        self.device_combo.set_visible(len(devices) > 1)
+
+    def on_device_combo_changed(self, widget):
+        """Switch cameras and remember the choice."""
+        node = self.device_combo.get_active_id()
+        if node is None or node == self.camera.get_device_node():
+            return
+        self.settings.set_string('camera-device', node)
+        self.camera.select_device(node)
+
+    def prewarm(self):
+        """Start the camera without showing the dialog, then stop it once it
+        runs. Showing the dialog later only has to restart the stream, and
+        the camera is released if the dialog is not shown in time."""
+        if self.camera is None:
+            return
+        self.start_time = None
+        self.prewarming = True
+        self.play()
+        if self.camera.state == Gst.State.PLAYING:
+            # The camera has already reported that it is running.
+            self.on_camera_state_changed(self.camera, self.camera.state)
 
     def on_camera_state_changed(self, widget, state):
-        if state == Gst.State.PLAYING or self.apply_button.get_sensitive():
+        if self.prewarming and state == Gst.State.PLAYING:
+            logger.debug('Camera pre-warmed')
+            self.prewarming = False
+            self.pause()
+            self.schedule_release()
+        if self.camera.capture_time is not None:
+            # Switching to the capture mode restarts the camera, keep the
+            # button insensitive until the photo is ready.
+            self.record_button.set_sensitive(False)
+        elif state == Gst.State.PLAYING or self.apply_button.get_sensitive():
             self.record_button.set_sensitive(True)
         else:
             self.record_button.set_sensitive(False)
 
-    def on_camera_photo_saved(self, widget, filename):
-        self.filename = filename
+    def on_camera_photo_saved(self, widget, image):
+        self.image = image
         self.apply_button.set_sensitive(True)
+        self.record_button.set_sensitive(True)
         self.camera.pause()
 
     def play(self):
-        self.camera.play()
+        if self.camera is not None:
+            self.camera.play()
 
     def pause(self):
-        self.camera.pause()
+        if self.camera is not None:
+            self.camera.pause()
 
     def stop(self):
-        self.camera.stop()
+        if self.camera is not None:
+            self.camera.stop()
 
-    def take_picture(self, filename):
-        self.camera.take_photo(filename)
+    def take_picture(self):
+        if self.camera is not None:
+            self.camera.take_photo()
 
     def on_camera_record_clicked(self, widget):
         """When the camera record/retry button is clicked:
         Record: Pause the video, start the capture, enable apply and retry.
         Retry: Restart the video stream."""
-        # Remove any previous temporary file.
-        if self.filename and os.path.isfile(self.filename):
-            os.remove(self.filename)
+        # Drop any previous photo.
+        self.image = None
 
         # Retry action.
         if self.apply_button.get_sensitive():
@@ -257,11 +218,8 @@ class CameraMugshotDialog(CameraDialog):
 
         # Record (Capture) action.
         else:
-            # Create a new temporary file.
-            self.filename = helpers.new_tempfile('camera')
-
             # Capture the current image.
-            self.take_picture(self.filename)
+            self.take_picture()
 
             # Set the record button to retry, and disable it until the capture
             # finishes.
@@ -270,9 +228,9 @@ class CameraMugshotDialog(CameraDialog):
 
     def on_camera_apply_clicked(self, widget):
         """When the camera Apply button is clicked, crop the current photo and
-        emit a signal to let the main application know there is a new file
+        emit a signal to let the main application know there is a new image
         available.  Then close the camera dialog."""
-        self.emit("apply", self.filename)
+        self.emit("apply", self.image)
         self.hide()
 
     def on_camera_cancel_clicked(self, widget):
@@ -280,23 +238,56 @@ class CameraMugshotDialog(CameraDialog):
         self.hide()
 
     def on_camera_mugshot_dialog_destroy(self, widget, data=None):
-        """When the application exits, remove the current temporary file and
-        stop the gstreamer element."""
-        # Clear away the temp file.
-        if self.filename and os.path.isfile(self.filename):
-            os.remove(self.filename)
+        """When the application exits, stop the gstreamer element."""
+        self.cancel_release()
+        if self.camera is None:
+            return
+        self.camera.stop_frame_timer()
         # Clean up the camera before exiting
         self.camera.stop()
 
     def on_camera_mugshot_dialog_hide(self, widget, data=None):
-        """When the dialog is hidden, pause the camera recording."""
+        """When the dialog is hidden, pause the camera recording and release
+        the camera once it has been idle for camera-idle-timeout seconds."""
         self.pause()
+        if self.camera is not None:
+            self.schedule_release()
+
+    def schedule_release(self):
+        """Release the camera after camera-idle-timeout seconds."""
+        self.cancel_release()
+        self.release_source = GLib.timeout_add_seconds(
+            self.settings.get_int('camera-idle-timeout'),
+            self.on_release_timeout)
+
+    def on_release_timeout(self):
+        self.release_source = None
+        self.camera.release()
+        return False
+
+    def cancel_release(self):
+        """Keep the camera when the dialog is shown again."""
+        if self.release_source is not None:
+            GLib.source_remove(self.release_source)
+            self.release_source = None
 
     def on_camera_mugshot_dialog_show(self, widget, data=None):
         """When the dialog is shown, set the record button to record, disable
         the apply button, and start the camera."""
+        self.cancel_release()
+        self.prewarming = False
+        if self.camera is None:
+            self.show_all()
+            return
+        if self.start_time is not None:
+            # The dialog was created to be shown now.
+            self.camera.start_frame_timer(self.start_time, 'cold')
+            self.start_time = None
+        else:
+            self.camera.start_frame_timer(time.monotonic(), 'warm')
         self.record_button.set_label(Gtk.STOCK_MEDIA_RECORD)
         self.apply_button.set_sensitive(False)
+        self.update_device_combo()
         self.show_all()
         self.play()
 
@@ -0,0 +1,388 @@
+#!/usr/bin/python3
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: nil; tab-width: 4 -*-
+#   Mugshot - Lightweight user configuration utility
+#   Copyright (C) 2013-2019 Sean Davis <sean@bluesabre.org>
+#
+#   Portions of this file are adapted from web_cam_box,
+#   Copyright (C) 2010 Rick Spencer <rick.spencer@canonical.com>
+#
+#   This program is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful, but
+#   WITHOUT ANY WARRANTY; without even the implied warranties of
+#   MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+#   PURPOSE.  See the GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Camera backend built on Cheese, Clutter and GtkClutter."""
+
+import logging
+
+import gi
+gi.require_version('Gst', '1.0')
+gi.require_version('Cheese', '3.0')
+gi.require_version('GtkClutter', '1.0')
+
+from gi.repository import GLib, Gst  # nopep8
+from gi.repository import Cheese, Clutter, GtkClutter  # nopep8
+
+from mugshot_lib import helpers  # nopep8
+from mugshot.CameraBox import CameraCapture, get_camera_box_signals  # nopep8
+from mugshot.CameraBox import default_preview_resolution  # nopep8
+from mugshot.CameraBox import settle_time  # nopep8
+
+logger = logging.getLogger('mugshot')
+
+# Milliseconds between attempts to capture the next frame of a burst while
+# Cheese is still busy with the previous one.
+burst_retry_interval = 10
+
+
+def has_cheese_backend_support():
+    """Return True if the elements used by this backend are available."""
+    if not Gst.is_initialized():
+        Gst.init(None)
+    missing = [element for element in ['v4l2src', 'camerabin']
+               if Gst.ElementFactory.find(element) is None]
+    if len(missing) > 0:
+        logger.debug('Cheese camera backend unavailable, missing %s' %
+                     ', '.join(missing))
+    return len(missing) == 0
+
+
+def get_device_node(device):
+    """Return the device node of a Cheese.CameraDevice, or None."""
+    if "get_device_node" in dir(device):
+        return device.get_device_node()
+    try:
+        properties = device.props.device.get_properties()
+    except (AttributeError, TypeError):
+        return None
+    if properties is None:
+        return None
+    for key in ['device.path', 'api.v4l2.path']:
+        node = properties.get_string(key)
+        if node is not None:
+            return node
+    return None
+
+
+def get_video_modes(device):
+    """Return the (width, height, jpeg, format) modes supported by a
+    Cheese.CameraDevice, where jpeg is True if the mode is available as
+    MJPEG."""
+    modes = []
+    for video_format in device.get_format_list():
+        caps = device.get_caps_for_format(video_format)
+        jpeg = any(caps.get_structure(index).get_name() == 'image/jpeg'
+                   for index in range(caps.get_size()))
+        modes.append((video_format.width, video_format.height, jpeg,
+                      video_format))
+    return modes
+
+
+class CheeseCameraBox(CameraCapture, GtkClutter.Embed):
+
+    """Camera preview and capture through Cheese and a Clutter stage."""
+    __gsignals__ = get_camera_box_signals()
+
+    backend = 'cheese'
+
+    def __init__(self, parent, settings):
+        Clutter.init(None)
+        GtkClutter.Embed.__init__(self)
+        self.init_capture(settings)
+        self.state = Gst.State.NULL
+        self.parent = parent
+        self.capture_pending = False
+
+        # Whether the pipeline has been started. Cheese only reports the
+        # PLAYING state, so self.state goes stale once it is stopped.
+        self.playing = False
+
+        # Supported modes of each device, enumerated once.
+        self.device_modes = {}
+        self.preview_mode = None
+        self.capture_mode = None
+        self.video_mode = None
+
+        # Capture devices by node, and the device in use.
+        self.devices = {}
+        self.device = None
+
+        self.video_texture = self.setup_ui()
+
+        self.camera = None
+        self.acquire()
+
+        def added(signal, data):
+            node = get_device_node(data)
+            capture_nodes = [device_node for device_node, name
+                             in helpers.get_video_devices()]
+            if node is not None and node not in capture_nodes:
+                logger.debug('Ignoring %s, not a capture device' % node)
+                return
+            self.devices[node] = data
+            # Use the configured device, or else the first one found.
+            if self.device is not None and \
+                    node != self.settings.get_string('camera-device'):
+                return
+            self.device = data
+            if self.camera is not None:
+                self.set_device(data)
+
+        device_monitor = Cheese.CameraDeviceMonitor.new()
+        device_monitor.connect("added", added)
+        device_monitor.coldplug()
+
+    def acquire(self):
+        """Create the camera pipeline and start the preview."""
+        preview_resolution = self.get_resolution_setting(
+            'camera-preview-resolution', default_preview_resolution)
+        self.camera = Cheese.Camera.new(self.video_texture, "Mugshot",
+                                        preview_resolution[0],
+                                        preview_resolution[1])
+        Cheese.Camera.setup(self.camera, None)
+
+        self.camera.connect("photo-taken", self.on_photo_taken)
+        self.camera.connect("state-flags-changed", self.on_state_flags_changed)
+        self.camera.connect("notify::format", self.on_format_changed)
+
+        self.video_mode = None
+        if self.device is not None:
+            self.set_device(self.device)
+        else:
+            self.update_video_modes()
+            self.set_video_mode(self.preview_mode)
+        if self.video_mode is None:
+            self.start_camera()
+        # The PLAYING state is reported by on_state_flags_changed once the
+        # pipeline has started.
+
+    def release(self):
+        """Destroy the camera pipeline, freeing the device and every buffer
+        held by it. play() acquires it again."""
+        if self.camera is None:
+            return
+        logger.debug('Releasing the camera')
+        self.stop_camera()
+        self.camera = None
+        self.video_mode = None
+        self.capture_pending = False
+        self.cancel_capture()
+        self.state = Gst.State.NULL
+
+    def select_device(self, node):
+        """Switch to the capture device with the specified node."""
+        device = self.devices.get(node)
+        if device is None or device is self.device:
+            return
+        self.device = device
+        if self.camera is not None:
+            self.set_device(device)
+
+    def get_device_node(self):
+        """Return the node of the device in use, or None."""
+        if self.device is None:
+            return None
+        return get_device_node(self.device)
+
+    def set_device(self, device):
+        """Switch the camera to a Cheese.CameraDevice."""
+        if "get_device_node" in dir(device):
+            node = device.get_device_node()
+            self.camera.set_device_by_device_node(node)
+        else:
+            self.camera.set_device(device)
+        self.camera.switch_camera_device()
+        self.video_mode = None
+        self.update_video_modes()
+        self.set_video_mode(self.preview_mode)
+
+    def update_video_modes(self):
+        """Choose the preview and capture modes of the current device."""
+        device = self.camera.get_selected_device()
+        if device is None:
+            return
+        key = get_device_node(device) or device.get_name()
+        if key not in self.device_modes:
+            self.device_modes[key] = get_video_modes(device)
+        self.preview_mode, self.capture_mode = \
+            self.get_video_mode_settings(self.device_modes[key])
+
+    def set_video_mode(self, mode):
+        """Restart the camera in the specified mode. Return False if the
+        camera is already using it."""
+        if mode is None or mode is self.video_mode:
+            return False
+        self.stop_camera()
+        self.camera.set_video_format(mode[3])
+        self.video_mode = mode
+        self.start_camera()
+        return True
+
+    def start_camera(self):
+        Cheese.Camera.play(self.camera)
+        self.playing = True
+
+    def stop_camera(self):
+        """Stop the pipeline. Cheese does not report it, so reset the state
+        here."""
+        Cheese.Camera.stop(self.camera)
+        self.playing = False
+        self.state = Gst.State.NULL
+
+    def setup_ui(self):
+        viewport = self.get_stage()
+
+        video_preview = Clutter.Actor.new()
+        video_preview.set_content_gravity(Clutter.ContentGravity.RESIZE_ASPECT)
+        video_preview.set_x_expand(True)
+        video_preview.set_y_expand(True)
+        video_preview.props.min_height = 100.0
+        video_preview.props.min_width = 100.0
+        video_texture = video_preview
+
+        viewport_layout = Clutter.Actor.new()
+        viewport_layout.add_child(video_preview)
+
+        viewport_layout_manager = Clutter.BinLayout()
+
+        background_layer = Clutter.Actor.new()
+        background_layer.props.background_color = \
+            Clutter.Color.from_string("Black")[1]
+        background_layer.props.x = 0
+        background_layer.props.y = 0
+        background_layer.props.width = 100
+        background_layer.props.height = 100
+
+        video_preview.props.request_mode = Clutter.RequestMode.HEIGHT_FOR_WIDTH
+
+        viewport.add_child(background_layer)
+
+        viewport_layout.set_layout_manager(viewport_layout_manager)
+
+        viewport.add_child(viewport_layout)
+
+        viewport.connect("allocation_changed", self.on_stage_resize,
+                         viewport_layout, background_layer)
+        self.viewport_layout = viewport_layout
+        self.background_layer = background_layer
+
+        return video_texture
+
+    def on_stage_resize(self, actor, box, flags, layout, background):
+        if self.camera is None:
+            return
+
+        s_width, s_height = self.get_stage().get_size()
+
+        v_width = self.camera.props.format.width
+        v_height = self.camera.props.format.height
+
+        square = min(s_width, s_height)
+        if v_width > v_height:
+            scale = square / v_height
+            v_height = square
+            v_width = v_width * scale
+        else:
+            scale = square / v_width
+            v_height = v_height * scale
+            v_width = square
+
+        x_adj, y_adj = (s_width - v_width) / 2.0, (s_height - v_height) / 2.0
+
+        layout.set_size(v_width, v_height)
+        layout.set_x(x_adj)
+        layout.set_y(y_adj)
+
+        background.set_size(s_width, s_height)
+
+    def start_frame_timer(self, start_time, label):
+        """Log the time from start_time until the next video frame is
+        drawn."""
+        content = self.video_texture.get_content()
+        if content is not None and hasattr(content, 'get_sink'):
+            source = content.get_sink()
+            handler = source.connect("new-frame", self.on_first_frame)
+        else:
+            # Fall back to the next stage paint.
+            source = self.get_stage()
+            handler = source.connect("after-paint", self.on_first_frame)
+        self.set_frame_timer(start_time, label,
+                             lambda: source.disconnect(handler))
+
+    def on_format_changed(self, camera, pspec):
+        """Fit the video to the stage again when the mode changes."""
+        self.on_stage_resize(None, None, None, self.viewport_layout,
+                             self.background_layer)
+
+    def on_state_flags_changed(self, camera, state):
+        self.state = state
+        if state == Gst.State.NULL:
+            # The pipeline stopped on an error.
+            self.playing = False
+        if state == Gst.State.PLAYING and self.capture_pending:
+            # The camera is now running in the capture mode, give it time to
+            # settle before taking the photo.
+            self.capture_pending = False
+            GLib.timeout_add(settle_time, self.take_settled_photo,
+                             self.capture_time)
+        self.emit("gst-state-changed", self.state)
+
+    def play(self):
+        if self.camera is None:
+            self.acquire()
+            return
+        # Return to the preview mode after taking a photo.
+        if self.set_video_mode(self.preview_mode):
+            return
+        if not self.playing:
+            self.start_camera()
+
+    def pause(self):
+        """Stop capturing, keeping the last frame on screen.
+
+        Cheese has no paused state, so the pipeline is stopped, which also
+        closes the device. The pipeline itself is kept for play()."""
+        if self.camera is not None and self.playing:
+            self.stop_camera()
+            self.emit("gst-state-changed", self.state)
+
+    def stop(self):
+        if self.camera is not None:
+            self.stop_camera()
+            self.emit("gst-state-changed", self.state)
+
+    def take_photo(self):
+        self.start_capture()
+        if self.set_video_mode(self.capture_mode):
+            # Take the photo once the camera restarts in the capture mode.
+            self.capture_pending = True
+            return True
+        return self.camera.take_photo_pixbuf()
+
+    def take_settled_photo(self, capture_time):
+        """Take the first photo of a burst once the camera has settled."""
+        if self.camera is not None and capture_time == self.capture_time:
+            self.camera.take_photo_pixbuf()
+        return False
+
+    def take_burst_frame(self):
+        """Capture the next frame of a burst, retrying until Cheese has
+        finished with the previous one."""
+        if self.camera is None or self.burst is None:
+            return False
+        return not self.camera.take_photo_pixbuf()
+
+    def on_photo_taken(self, camera, pixbuf):
+        """Collect the frames of a burst, capturing the next one from the
+        main loop. A timeout rather than an idle source is used, so waiting
+        for Cheese does not spin the CPU."""
+        if self.add_burst_frame(pixbuf):
+            GLib.timeout_add(burst_retry_interval, self.take_burst_frame)
@@ -0,0 +1,311 @@
+#!/usr/bin/python3
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: nil; tab-width: 4 -*-
+#   Mugshot - Lightweight user configuration utility
+#   Copyright (C) 2013-2019 Sean Davis <sean@bluesabre.org>
+#
+#   This program is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful, but
+#   WITHOUT ANY WARRANTY; without even the implied warranties of
+#   MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+#   PURPOSE.  See the GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Lightweight camera backend built on a plain GStreamer pipeline.
+
+    v4l2src ! capsfilter ! decodebin ! videoconvert ! tee
+        tee. ! queue ! gtksink
+        tee. ! valve ! queue ! videoconvert ! RGB ! appsink
+
+The preview is drawn by gtksink, and stills are pulled from the appsink
+branch, which only passes frames while a photo is being taken. Cheese,
+Clutter and a GL stage are not needed."""
+
+import logging
+import threading
+
+import gi
+gi.require_version('Gst', '1.0')
+
+from gi.repository import Gtk, GdkPixbuf, GLib, Gst  # nopep8
+
+from mugshot_lib import helpers  # nopep8
+from mugshot.CameraBox import CameraCapture, get_camera_box_signals  # nopep8
+from mugshot.CameraBox import settle_frames  # nopep8
+
+logger = logging.getLogger('mugshot')
+
+pipeline_description = (
+    'v4l2src name=source ! capsfilter name=filter ! decodebin name=decoder '
+    'videoconvert name=convert ! tee name=tee '
+    'tee. ! queue ! gtksink name=sink '
+    'tee. ! valve name=valve drop=true ! '
+    'queue leaky=downstream max-size-buffers=1 ! videoconvert ! '
+    'video/x-raw,format=RGB ! '
+    'appsink name=stills max-buffers=1 drop=true sync=false')
+
+# Time to wait for each still frame, in nanoseconds.
+still_timeout = Gst.SECOND
+
+
+def has_gstreamer_backend_support():
+    """Return True if the elements used by this backend are available."""
+    if not Gst.is_initialized():
+        Gst.init(None)
+    missing = [element for element in ['v4l2src', 'decodebin', 'gtksink',
+                                       'appsink']
+               if Gst.ElementFactory.find(element) is None]
+    if len(missing) > 0:
+        logger.debug('GStreamer camera backend unavailable, missing %s' %
+                     ', '.join(missing))
+    return len(missing) == 0
+
+
+def get_video_modes(caps):
+    """Return the (width, height, jpeg, caps) modes of the caps of a v4l2src
+    pad, where jpeg is True if the mode is available as MJPEG and caps is a
+    caps string selecting the mode."""
+    modes = {}
+    for index in range(caps.get_size()):
+        structure = caps.get_structure(index)
+        name = structure.get_name()
+        if name not in ['image/jpeg', 'video/x-raw']:
+            continue
+        has_width, width = structure.get_int('width')
+        has_height, height = structure.get_int('height')
+        if not has_width or not has_height:
+            # Skip size ranges, webcams list discrete sizes.
+            continue
+        jpeg = name == 'image/jpeg'
+        mode = (width, height, jpeg,
+                '%s,width=%i,height=%i' % (name, width, height))
+        # Prefer MJPEG for every size.
+        if (width, height) not in modes or \
+                (jpeg and not modes[(width, height)][2]):
+            modes[(width, height)] = mode
+    return list(modes.values())
+
+
+def get_sample_pixbuf(sample):
+    """Return an RGB video sample as a pixbuf."""
+    structure = sample.get_caps().get_structure(0)
+    width = structure.get_int('width')[1]
+    height = structure.get_int('height')[1]
+    buf = sample.get_buffer()
+    data = buf.extract_dup(0, buf.get_size())
+    return GdkPixbuf.Pixbuf.new_from_bytes(GLib.Bytes.new(data),
+                                           GdkPixbuf.Colorspace.RGB, False, 8,
+                                           width, height, len(data) // height)
+
+
+class GstCameraBox(CameraCapture, Gtk.Box):
+
+    """Camera preview and capture through v4l2src and gtksink."""
+    __gsignals__ = get_camera_box_signals()
+
+    backend = 'gstreamer'
+
+    def __init__(self, parent, settings):
+        Gtk.Box.__init__(self)
+        self.init_capture(settings)
+        self.state = Gst.State.NULL
+        self.parent = parent
+
+        # Supported modes of each device, enumerated once.
+        self.device_modes = {}
+        self.preview_mode = None
+        self.capture_mode = None
+        self.video_mode = None
+
+        self.device_node = None
+        self.pipeline = None
+        self.sink_widget = None
+        self.acquire()
+
+    def choose_device_node(self):
+        """Return the configured capture device, or else the first one."""
+        nodes = [node for node, name in helpers.get_video_devices()]
+        preferred = self.settings.get_string('camera-device')
+        if preferred in nodes:
+            return preferred
+        if len(nodes) > 0:
+            return nodes[0]
+        return None
+
+    def acquire(self):
+        """Create the camera pipeline and start the preview."""
+        if self.device_node is None:
+            self.device_node = self.choose_device_node()
+
+        self.pipeline = Gst.parse_launch(pipeline_description)
+        source = self.pipeline.get_by_name('source')
+        if self.device_node is not None:
+            source.set_property('device', self.device_node)
+        convert = self.pipeline.get_by_name('convert')
+        self.pipeline.get_by_name('decoder').connect(
+            'pad-added', lambda decoder, pad:
+            pad.link(convert.get_static_pad('sink')))
+
+        self.sink_widget = self.pipeline.get_by_name('sink') \
+            .get_property('widget')
+        self.pack_start(self.sink_widget, True, True, 0)
+        self.sink_widget.show()
+
+        bus = self.pipeline.get_bus()
+        bus.add_signal_watch()
+        bus.connect('message::state-changed', self.on_state_changed)
+        bus.connect('message::error', self.on_error)
+
+        # Open the device to read its modes before starting the stream.
+        self.video_mode = None
+        self.pipeline.set_state(Gst.State.READY)
+        self.update_video_modes(source)
+        self.set_video_mode(self.preview_mode)
+        self.pipeline.set_state(Gst.State.PLAYING)
+
+    def release(self):
+        """Destroy the camera pipeline, freeing the device and every buffer
+        held by it. play() acquires it again."""
+        if self.pipeline is None:
+            return
+        logger.debug('Releasing the camera')
+        self.stop_frame_timer()
+        self.pipeline.set_state(Gst.State.NULL)
+        self.pipeline.get_bus().remove_signal_watch()
+        self.remove(self.sink_widget)
+        self.sink_widget = None
+        self.pipeline = None
+        self.video_mode = None
+        self.cancel_capture()
+        self.state = Gst.State.NULL
+
+    def select_device(self, node):
+        """Switch to the capture device with the specified node."""
+        if node == self.device_node:
+            return
+        self.device_node = node
+        if self.pipeline is not None:
+            self.release()
+            self.acquire()
+
+    def get_device_node(self):
+        """Return the node of the device in use, or None."""
+        return self.device_node
+
+    def update_video_modes(self, source):
+        """Choose the preview and capture modes of the current device."""
+        if self.device_node not in self.device_modes:
+            caps = source.get_static_pad('src').query_caps(None)
+            self.device_modes[self.device_node] = get_video_modes(caps)
+        self.preview_mode, self.capture_mode = \
+            self.get_video_mode_settings(self.device_modes[self.device_node])
+
+    def set_video_mode(self, mode):
+        """Switch the stream to the specified mode, leaving the pipeline in
+        the READY state. Return False if the stream already uses it."""
+        if mode is None or mode is self.video_mode:
+            return False
+        if self.pipeline.get_state(0)[1] > Gst.State.READY:
+            self.pipeline.set_state(Gst.State.READY)
+        self.pipeline.get_by_name('filter').set_property(
+            'caps', Gst.Caps.from_string(mode[3]))
+        self.video_mode = mode
+        return True
+
+    def on_state_changed(self, bus, message):
+        if message.src is not self.pipeline:
+            return
+        old, new, pending = message.parse_state_changed()
+        self.state = new
+        self.emit("gst-state-changed", self.state)
+
+    def on_error(self, bus, message):
+        error, debug = message.parse_error()
+        logger.warning('Camera error: %s' % error.message)
+        logger.debug(debug)
+
+    def start_frame_timer(self, start_time, label):
+        """Log the time from start_time until the next video frame reaches
+        the preview sink."""
+        if self.pipeline is None:
+            self.acquire()
+        pad = self.pipeline.get_by_name('sink').get_static_pad('sink')
+        probe = pad.add_probe(Gst.PadProbeType.BUFFER, self.on_sink_buffer)
+        self.set_frame_timer(start_time, label,
+                             lambda: pad.remove_probe(probe))
+
+    def on_sink_buffer(self, pad, info):
+        """Streaming thread: a frame reached the preview sink."""
+        GLib.idle_add(self.on_first_frame)
+        return Gst.PadProbeReturn.OK
+
+    def play(self):
+        if self.pipeline is None:
+            self.acquire()
+            return
+        # Return to the preview mode after taking a photo.
+        self.set_video_mode(self.preview_mode)
+        self.pipeline.set_state(Gst.State.PLAYING)
+
+    def pause(self):
+        """Pause the stream, keeping the last frame on screen. The device
+        stays open until the camera is released."""
+        if self.pipeline is not None:
+            self.pipeline.set_state(Gst.State.PAUSED)
+
+    def stop(self):
+        if self.pipeline is not None:
+            self.pipeline.set_state(Gst.State.NULL)
+
+    def take_photo(self):
+        if self.pipeline is None:
+            return False
+        self.start_capture()
+        skip = 0
+        if self.set_video_mode(self.capture_mode):
+            self.pipeline.set_state(Gst.State.PLAYING)
+            # Let the camera settle in the capture mode.
+            skip = settle_frames
+        self.pipeline.get_by_name('valve').set_property('drop', False)
+        thread = threading.Thread(
+            target=self.pull_frames,
+            args=(self.pipeline.get_by_name('stills'), self.burst_size,
+                  self.capture_time, skip))
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def pull_frames(self, stills, count, capture_time, skip=0):
+        """Worker thread: pull the frames of a burst from the appsink, after
+        discarding the first skip frames."""
+        for index in range(skip):
+            if stills.emit('try-pull-sample', still_timeout) is None:
+                break
+        pixbufs = []
+        for index in range(count):
+            sample = stills.emit('try-pull-sample', still_timeout)
+            if sample is None:
+                break
+            pixbufs.append(get_sample_pixbuf(sample))
+        GLib.idle_add(self.on_frames_pulled, pixbufs, capture_time)
+
+    def on_frames_pulled(self, pixbufs, capture_time):
+        """Hand the pulled frames over to the photo processing."""
+        if self.pipeline is not None:
+            self.pipeline.get_by_name('valve').set_property('drop', True)
+        if capture_time != self.capture_time:
+            return False
+        if len(pixbufs) == 0:
+            logger.warning('No frame received from the camera.')
+            self.cancel_capture()
+            self.emit("gst-state-changed", self.state)
+            return False
+        self.burst_size = len(pixbufs)
+        for pixbuf in pixbufs:
+            self.add_burst_frame(pixbuf)
+        return False
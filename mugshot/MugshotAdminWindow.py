@@ -0,0 +1,280 @@
+#!/usr/bin/python3
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: nil; tab-width: 4 -*-
+#   Mugshot - Lightweight user configuration utility
+#   Copyright (C) 2013-2019 Sean Davis <sean@bluesabre.org>
+#
+#   This program is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful, but
+#   WITHOUT ANY WARRANTY; without even the implied warranties of
+#   MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+#   PURPOSE.  See the GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from locale import gettext as _
+
+import logging
+
+from gi.repository import Gtk, GLib, Gio  # pylint: disable=E0611
+
+from mugshot_lib import AccountsServiceAdapter, helpers, imaging
+
+logger = logging.getLogger('mugshot')
+
+# Thumbnail size of the user list avatars, in pixels.
+thumbnail_size = 48
+
+# Model columns
+COLUMN_PATH = 0
+COLUMN_USERNAME = 1
+COLUMN_REAL_NAME = 2
+COLUMN_EMAIL = 3
+COLUMN_ICON_FILE = 4
+
+
+class MugshotAdminWindow(Gtk.Window):
+
+    """Manage the profile image and details of every user on the system.
+
+    Users are enumerated once with ListCachedUsers and added to the list as
+    their properties arrive. Avatar thumbnails are only decoded when their
+    row is drawn."""
+    __gtype_name__ = "MugshotAdminWindow"
+
+    def __init__(self):
+        """Initialize the MugshotAdminWindow."""
+        super(MugshotAdminWindow, self).__init__(title=_("Mugshot"))
+        self.set_wmclass("Mugshot", "Mugshot")
+        self.set_icon_name("mugshot")
+        self.set_default_size(640, 480)
+        self.connect("destroy", self.on_destroy)
+
+        self.cancellable = Gio.Cancellable()
+        self.settings = Gio.Settings.new("apps.mugshot")
+
+        # Adapters for each managed user, keyed by object path.
+        self.adapters = {}
+
+        # Decoded thumbnails keyed by icon filename, None if unavailable.
+        self.thumbnails = {}
+        self.pending_thumbnails = []
+
+        grid = Gtk.Grid.new()
+        grid.set_row_spacing(6)
+        grid.set_border_width(6)
+        self.add(grid)
+
+        self.model = Gtk.ListStore(str, str, str, str, str)
+        self.model.set_sort_column_id(COLUMN_USERNAME,
+                                      Gtk.SortType.ASCENDING)
+
+        self.treeview = Gtk.TreeView.new_with_model(self.model)
+        self.treeview.set_fixed_height_mode(True)
+        self.treeview.get_selection().connect("changed",
+                                              self.on_selection_changed)
+
+        renderer = Gtk.CellRendererPixbuf()
+        renderer.set_fixed_size(thumbnail_size, thumbnail_size)
+        column = Gtk.TreeViewColumn("", renderer)
+        column.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
+        column.set_fixed_width(thumbnail_size + 12)
+        column.set_cell_data_func(renderer, self.render_thumbnail)
+        self.treeview.append_column(column)
+
+        for title, column_id, editable in [
+                (_("Username"), COLUMN_USERNAME, False),
+                (_("Name"), COLUMN_REAL_NAME, True),
+                (_("Email Address"), COLUMN_EMAIL, True)]:
+            renderer = Gtk.CellRendererText()
+            renderer.set_property("editable", editable)
+            if editable:
+                renderer.connect("edited", self.on_cell_edited, column_id)
+            column = Gtk.TreeViewColumn(title, renderer, text=column_id)
+            column.set_sizing(Gtk.TreeViewColumnSizing.FIXED)
+            column.set_fixed_width(180)
+            column.set_resizable(True)
+            column.set_sort_column_id(column_id)
+            self.treeview.append_column(column)
+
+        scrolled = Gtk.ScrolledWindow()
+        scrolled.set_hexpand(True)
+        scrolled.set_vexpand(True)
+        scrolled.set_shadow_type(Gtk.ShadowType.IN)
+        scrolled.add(self.treeview)
+        grid.attach(scrolled, 0, 0, 1, 1)
+
+        button_box = Gtk.ButtonBox.new(Gtk.Orientation.HORIZONTAL)
+        button_box.set_layout(Gtk.ButtonBoxStyle.END)
+        button_box.set_spacing(6)
+        self.image_button = Gtk.Button.new_with_label(_("Change Picture…"))
+        self.image_button.set_sensitive(False)
+        self.image_button.connect("clicked", self.on_image_button_clicked)
+        button_box.pack_start(self.image_button, False, False, 0)
+        close_button = Gtk.Button.new_with_label(_("Close"))
+        close_button.connect("clicked", lambda button: self.destroy())
+        button_box.pack_start(close_button, False, False, 0)
+        grid.attach(button_box, 0, 1, 1, 1)
+
+        self.show_all()
+
+        logger.debug('Enumerating AccountsService users')
+        AccountsServiceAdapter.get_cached_users_async(self.on_user_loaded,
+                                                      self.on_users_loaded,
+                                                      self.cancellable)
+
+    def on_user_loaded(self, path, props):
+        """Add a user to the list as soon as its properties arrive."""
+        if self.cancellable.is_cancelled():
+            return
+        self.model.append([path, props["UserName"], props["RealName"],
+                           props["Email"], props["IconFile"]])
+
+    def on_users_loaded(self, count):
+        logger.debug('Loaded %i users' % count)
+
+    def get_adapter(self, path, username):
+        """Return the AccountsService adapter for the given user."""
+        if path not in self.adapters:
+            self.adapters[path] = \
+                AccountsServiceAdapter.MugshotAccountsServiceAdapter(
+                    username, path=path)
+        return self.adapters[path]
+
+    # = Thumbnails ========================================================== #
+    def render_thumbnail(self, column, cell, model, treeiter, data=None):
+        """Draw the avatar for a visible row, scheduling its decode if it has
+        not been loaded yet."""
+        icon_file = model[treeiter][COLUMN_ICON_FILE]
+        pixbuf = self.thumbnails.get(icon_file)
+        if pixbuf is not None:
+            cell.set_property("pixbuf", pixbuf)
+            return
+        cell.set_property("icon-name", "avatar-default")
+        if icon_file and icon_file not in self.thumbnails and \
+                icon_file not in self.pending_thumbnails:
+            self.pending_thumbnails.append(icon_file)
+            if len(self.pending_thumbnails) == 1:
+                GLib.idle_add(self.load_thumbnails)
+
+    def load_thumbnails(self):
+        """Decode one pending thumbnail per idle iteration."""
+        if len(self.pending_thumbnails) == 0:
+            return False
+        icon_file = self.pending_thumbnails.pop(0)
+        self.thumbnails[icon_file] = helpers.get_scaled_pixbuf(
+            icon_file, thumbnail_size, thumbnail_size)
+        self.treeview.queue_draw()
+        return len(self.pending_thumbnails) > 0
+
+    # = Editing ============================================================= #
+    def on_selection_changed(self, selection):
+        model, treeiter = selection.get_selected()
+        self.image_button.set_sensitive(treeiter is not None)
+
+    def on_cell_edited(self, renderer, path, text, column_id):
+        """Save an edited name or email address to AccountsService."""
+        row = self.model[path]
+        text = text.strip()
+        if row[column_id] == text:
+            return
+        row[column_id] = text
+        adapter = self.get_adapter(row[COLUMN_PATH], row[COLUMN_USERNAME])
+        if column_id == COLUMN_REAL_NAME:
+            adapter.set_real_name_async(text, self.on_property_saved)
+        else:
+            adapter.set_email_async(text, self.on_property_saved)
+
+    def on_property_saved(self, success):
+        if not success:
+            logger.warning('Unable to save user details to AccountsService.')
+
+    def on_image_button_clicked(self, widget):
+        """Browse for a new profile image for the selected user."""
+        model, treeiter = self.treeview.get_selection().get_selected()
+        if treeiter is None:
+            return
+
+        chooser = Gtk.FileChooserDialog(title=_("Select an image"),
+                                        transient_for=self,
+                                        action=Gtk.FileChooserAction.OPEN)
+        chooser.add_button(_("Cancel"), Gtk.ResponseType.CANCEL)
+        chooser.add_button(_("Apply"), Gtk.ResponseType.APPLY)
+        image_filter = Gtk.FileFilter()
+        image_filter.set_name('Images')
+        image_filter.add_mime_type('image/*')
+        chooser.add_filter(image_filter)
+        response = chooser.run()
+        filename = chooser.get_filename()
+        chooser.destroy()
+        if response != Gtk.ResponseType.APPLY or not filename:
+            return
+
+        # AccountsService rejects large icons, so crop and scale the image
+        # with the profile image settings first.
+        identifier = 'icon-file-%s' % model[treeiter][COLUMN_PATH]
+        icon_file = self.install_image(filename, identifier)
+        if icon_file is None:
+            self.show_error(_("The selected image could not be loaded."))
+            return
+
+        row_reference = Gtk.TreeRowReference.new(model,
+                                                 model.get_path(treeiter))
+        adapter = self.get_adapter(model[treeiter][COLUMN_PATH],
+                                   model[treeiter][COLUMN_USERNAME])
+
+        def on_icon_saved(success):
+            # AccountsService has made its own copy.
+            helpers.remove_tempfile(identifier)
+            if not success:
+                logger.warning('Unable to save profile image to '
+                               'AccountsService.')
+                self.show_error(_("The profile image could not be saved."))
+                return
+            # AccountsService copies the image, so fetch its new location.
+            adapter.get_icon_file_async(on_icon_file)
+
+        def on_icon_file(icon_file):
+            if not row_reference.valid() or not icon_file:
+                return
+            self.thumbnails.pop(icon_file, None)
+            model[row_reference.get_path()][COLUMN_ICON_FILE] = icon_file
+
+        adapter.set_icon_file_async(icon_file, on_icon_saved)
+
+    def install_image(self, filename, identifier):
+        """Write a square, size-bounded copy of filename to the temporary file
+        registered as identifier, using the profile image settings. Return
+        the temporary filename, or None if the image cannot be loaded."""
+        pixbuf = imaging.crop_files([filename])[0]
+        if pixbuf is None:
+            return None
+        icon_file = helpers.new_tempfile(identifier)
+        image = imaging.ImageHandle(pixbuf=pixbuf)
+        if not image.install(icon_file,
+                             self.settings.get_int('avatar-max-size'),
+                             self.settings.get_string('avatar-format'),
+                             self.settings.get_int('avatar-compression'),
+                             self.settings.get_int('avatar-quality')):
+            helpers.remove_tempfile(identifier)
+            return None
+        return icon_file
+
+    def show_error(self, primary_message):
+        """Tell the user that the profile image was not updated."""
+        dialog = Gtk.MessageDialog(transient_for=self, flags=0,
+                                   message_type=Gtk.MessageType.ERROR,
+                                   buttons=Gtk.ButtonsType.OK,
+                                   text=primary_message)
+        dialog.format_secondary_text(_("The profile image was not updated."))
+        dialog.run()
+        dialog.destroy()
+
+    def on_destroy(self, widget, data=None):
+        """Called when the MugshotAdminWindow is closed."""
+        self.cancellable.cancel()
+        Gtk.main_quit()
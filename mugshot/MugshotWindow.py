@@ -18,24 +18,29 @@
 
 from locale import gettext as _
 
+import glob
+import json
 import logging
 import os
-import shutil
 import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import dbus
 import pexpect
 
-from gi.repository import Gtk, GdkPixbuf, GLib, Gdk  # pylint: disable=E0611
-import cairo
+from gi.repository import Gtk, GdkPixbuf, GLib, Gio  # pylint: disable=E0611
 
 
 from mugshot_lib import Window, SudoDialog, AccountsServiceAdapter, helpers
+from mugshot_lib import imaging
+from mugshot_lib import get_version
 
 try:
-    from mugshot.CameraMugshotDialog import CameraMugshotDialog
+    from mugshot.CameraMugshotDialog import CameraMugshotDialog, \
+        get_camera_box_class
 except:
-    pass
+    get_camera_box_class = None
 
 logger = logging.getLogger('mugshot')
 
@@ -45,6 +50,14 @@ libreoffice_prefs = os.path.join(GLib.get_user_config_dir(), 'libreoffice',
                                  '4', 'user', 'registrymodifications.xcu')
 pidgin_prefs = os.path.join(home, '.purple', 'prefs.xml')
 faces_dir = '/usr/share/pixmaps/faces/'
+# Stock face thumbnails are decoded by this many worker threads.
+stock_thumbnail_workers = 4
+# Maximum dimension of the image used for the interactive crop preview.
+preview_proxy_size = 512
+# Deadline for AccountsService calls, in milliseconds.
+accounts_service_timeout = 10000
+camera_support_cache = os.path.join(GLib.get_user_cache_dir(), 'mugshot',
+                                    'camera-support.json')
 
 
 def which(command):
@@ -67,66 +80,122 @@ def has_running_process(name):
     return int(n) > 0
 
 
-def has_gstreamer_camerabin_support():
-    """Return True if gstreamer1.0 camerabin element is available."""
-    process = subprocess.Popen(["gst-inspect-1.0", "camerabin"],
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE)
-    process.communicate()
-    has_support = process.returncode == 0
-    if not has_support:
-        element = 'camerabin'
-        plugin = 'gstreamer1.0-plugins-good'
-        logger.debug('%s element unavailable. '
-                     'Do you have %s installed?' % (element, plugin))
-    return has_support
-
-
-def has_gstreamer_camerasrc_support():
-    """Return True if gstreamer1.0 v4l2src element is available."""
-    process = subprocess.Popen(["gst-inspect-1.0", "v4l2src"],
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE)
-    process.communicate()
-    has_support = process.returncode == 0
-    if not has_support:
-        element = 'v4l2src'
-        plugin = 'gstreamer1.0-plugins-good'
-        logger.debug('%s element unavailable. '
-                     'Do you have %s installed?' % (element, plugin))
-    return has_support
-
-
-def has_camera_libraries():
-    """Return True if it is possible to display the camera dialog."""
-    try:
-        from gi.repository import Cheese, Clutter, GtkClutter  # pylint: disable=W0612
-    except:
+def get_camera_installed():
+    """Return True if a video capture device is present."""
+    if len(helpers.get_video_devices()) == 0:
+        logger.debug('Camera not detected')
         return False
     return True
 
 
-def get_camera_installed():
-    """Return True if /dev/video0 exists."""
-    if not os.path.exists('/dev/video0'):
-        logger.debug('Camera not detected at /dev/video0')
-        return False
-    return True
+def get_gstreamer_registry_files():
+    """Return the GStreamer registry files that may be used by this user."""
+    filenames = []
+    for variable in ['GST_REGISTRY_1_0', 'GST_REGISTRY']:
+        if variable in os.environ:
+            filenames.append(os.environ[variable])
+    filenames += glob.glob(os.path.join(GLib.get_user_cache_dir(),
+                                        'gstreamer-1.0', 'registry.*.bin'))
+    return sorted(set(filenames))
+
+
+def get_search_path_dirs(variables, patterns):
+    """Return the directories listed in the environment variables, followed
+    by those matching the glob patterns."""
+    dirnames = []
+    for variable in variables:
+        if variable in os.environ:
+            dirnames += [dirname for dirname in
+                         os.environ[variable].split(os.pathsep) if dirname]
+    for pattern in patterns:
+        dirnames += sorted(glob.glob(pattern))
+    return dirnames
+
+
+def get_gstreamer_plugin_dirs():
+    """Return the directories GStreamer may load plugins from."""
+    return get_search_path_dirs(
+        ['GST_PLUGIN_PATH_1_0', 'GST_PLUGIN_PATH',
+         'GST_PLUGIN_SYSTEM_PATH_1_0', 'GST_PLUGIN_SYSTEM_PATH'],
+        [os.path.join(GLib.get_user_data_dir(), 'gstreamer-1.0', 'plugins'),
+         '/usr/lib/gstreamer-1.0', '/usr/lib/*/gstreamer-1.0',
+         '/usr/lib64/gstreamer-1.0', '/usr/local/lib/gstreamer-1.0',
+         '/usr/local/lib/*/gstreamer-1.0'])
+
+
+def get_typelib_dirs():
+    """Return the directories GObject introspection may load typelibs from,
+    such as those of Cheese and GtkClutter."""
+    return get_search_path_dirs(
+        ['GI_TYPELIB_PATH'],
+        ['/usr/lib/girepository-1.0', '/usr/lib/*/girepository-1.0',
+         '/usr/lib64/girepository-1.0', '/usr/local/lib/girepository-1.0',
+         '/usr/local/lib/*/girepository-1.0'])
+
+
+def get_camera_support_fingerprint():
+    """Return a string that changes whenever the GStreamer registry, the
+    installed GStreamer plugins or introspection typelibs, or the available
+    video devices change. Installing or removing a package changes the
+    modification time of the directories it adds files to."""
+    fingerprint = [get_version()]
+    filenames = get_gstreamer_registry_files() + \
+        get_gstreamer_plugin_dirs() + get_typelib_dirs() + \
+        sorted(glob.glob('/dev/video*'))
+    for filename in filenames:
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            continue
+        fingerprint.append('%s:%i:%i:%i' % (filename, stat.st_mtime_ns,
+                                            stat.st_size, stat.st_rdev))
+    return '|'.join(fingerprint)
+
+
+def get_cached_camera_support(fingerprint):
+    """Return the cached camera support, or None if it is missing or
+    outdated."""
+    try:
+        with open(camera_support_cache, 'r') as cache:
+            data = json.load(cache)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(data, dict) or data.get('fingerprint') != fingerprint:
+        logger.debug('Camera support cache is outdated.')
+        return None
+    return data.get('supported') is True
+
+
+def set_cached_camera_support(fingerprint, supported):
+    """Store the camera support for the given fingerprint."""
+    try:
+        os.makedirs(os.path.dirname(camera_support_cache), exist_ok=True)
+        with open(camera_support_cache, 'w') as cache:
+            json.dump({'fingerprint': fingerprint,
+                       'supported': supported}, cache)
+    except OSError:
+        logger.debug('Unable to write %s' % camera_support_cache)
 
 
 def get_has_camera_support():
     """Return True if cameras are fully supported by this application."""
     if not get_camera_installed():
         return False
-    if not which('gst-inspect-1.0'):
-        return False
-    if not has_gstreamer_camerabin_support():
-        return False
-    if not has_gstreamer_camerasrc_support():
-        return False
-    if not has_camera_libraries():
-        return False
-    return True
+
+    supported = get_cached_camera_support(get_camera_support_fingerprint())
+    if supported is not None:
+        logger.debug('Using cached camera support: %s' % supported)
+        return supported
+
+    # Use the same checks as the camera dialog, so the camera is only
+    # offered if one of its backends can be loaded.
+    supported = get_camera_box_class is not None and \
+        get_camera_box_class() is not None
+
+    # Initializing GStreamer may have rebuilt the registry, so fingerprint
+    # the system after probing.
+    set_cached_camera_support(get_camera_support_fingerprint(), supported)
+    return supported
 
 
 def detach_cb(menu, widget):
@@ -186,6 +255,9 @@ class MugshotWindow(Window):
         if get_has_camera_support():
             self.CameraDialog = CameraMugshotDialog
             self.image_from_camera.set_visible(True)
+            if self.settings.get_boolean('camera-prewarm'):
+                GLib.idle_add(self.prewarm_camera_dialog,
+                              priority=GLib.PRIORITY_LOW)
         else:
             self.image_from_camera.set_visible(False)
 
@@ -201,6 +273,11 @@ class MugshotWindow(Window):
         # Stock photo browser
         self.stock_browser = builder.get_object('stock_browser')
         self.iconview = builder.get_object('stock_iconview')
+        self.stock_executor = None
+        self.stock_cancel = None
+        self.stock_thumbnails = set()
+        # Stock photos submitted to the thread pool but not finished yet.
+        self.stock_loading = set()
 
         # File Chooser Dialog
         self.chooser = builder.get_object('filechooserdialog')
@@ -213,6 +290,9 @@ class MugshotWindow(Window):
         self.zoom_scale = builder.get_object('zoom_scale')
         self.x_spin_button = builder.get_object('x_spin_button')
         self.y_spin_button = builder.get_object('y_spin_button')
+        self.preview_cache = helpers.PixbufCache()
+        self.preview_render_source = None
+        self.filechooser_crop = None
 
         # Add a filter for only image files.
         image_filter = Gtk.FileFilter()
@@ -222,13 +302,23 @@ class MugshotWindow(Window):
 
         self.tmpfile = None
 
-        self.accounts_service = \
-            AccountsServiceAdapter.MugshotAccountsServiceAdapter(username)
+        self.apply_button = builder.get_object('apply_button')
 
-        # Users without sudo rights cannot change their name.
-        if not self.accounts_service.available():
-            self.set_name_editable(SudoDialog.check_dependencies(['chfn']))
-        self.set_phone_editable(SudoDialog.check_dependencies(['chfn']))
+        # The user is looked up in init_user_details, without blocking.
+        self.accounts_service = \
+            AccountsServiceAdapter.MugshotAccountsServiceAdapter(
+                username, cached=True, timeout=accounts_service_timeout,
+                resolve=False)
+        self.accounts_service_cancellable = Gio.Cancellable()
+
+        # Users without sudo rights cannot change their name unless
+        # AccountsService is available. Both checks are slow, so keep the
+        # entries insensitive until they complete.
+        self.chfn_available = None
+        self.set_name_editable(False)
+        self.set_phone_editable(False)
+        SudoDialog.check_dependencies_async(['chfn'],
+                                            self.on_chfn_dependencies_checked)
 
         # Populate all of the widgets.
         self.init_user_details()
@@ -243,41 +333,86 @@ class MugshotWindow(Window):
         self.home_phone_entry.set_sensitive(editable)
         self.office_phone_entry.set_sensitive(editable)
 
+    def on_chfn_dependencies_checked(self, available):
+        """Update the chfn entries once sudo rights are known."""
+        logger.debug('chfn available: %s' % available)
+        self.chfn_available = available
+        self.update_name_editable()
+        self.set_phone_editable(available)
+
+    def update_name_editable(self):
+        """Allow editing the name through AccountsService or chfn."""
+        self.set_name_editable(self.accounts_service.available() or
+                               self.chfn_available is True)
+
     def init_user_details(self):
         """Initialize the user details entries and variables."""
+        # Changes cannot be applied until the details are loaded.
+        self.apply_button.set_sensitive(False)
+
+        logger.debug('Checking AccountsService for user details')
+        self.accounts_service.resolve_async(
+            self.on_accounts_service_resolved,
+            self.accounts_service_cancellable)
+
+    def on_accounts_service_resolved(self, available):
+        """Load the user details once the user has been looked up."""
+        if self.accounts_service_cancellable.is_cancelled():
+            return
+        self.update_name_editable()
+        if not available:
+            # AccountsService may not be supported, desired or responding.
+            logger.debug("AccountsService is not supported.")
+            self.on_user_details_loaded(None)
+        else:
+            self.accounts_service.get_properties_async(
+                self.on_user_details_loaded,
+                self.accounts_service_cancellable)
+
+    def on_user_details_loaded(self, as_props):
+        """Populate the user details once AccountsService has replied."""
+        if self.accounts_service_cancellable.is_cancelled():
+            return
+
         # Check for .face and set profile image.
         logger.debug('Checking for ~/.face profile image')
         face = os.path.join(home, '.face')
 
-        logger.debug('Checking AccountsService for profile image')
         if not self.accounts_service.available():
-            # AccountsService may not be supported or desired.
-            logger.debug("AccountsService is not supported.")
-            self.updated_image = face
-            self.set_user_image(face)
+            if os.path.isfile(face):
+                self.updated_image = imaging.ImageHandle(face)
+            else:
+                self.updated_image = None
+            self.set_user_image(self.updated_image)
+
+        elif as_props is None:
+            logger.warning('AccountsService did not respond.')
+            self.updated_image = None
+            self.set_user_image(imaging.ImageHandle(face))
 
         # If it is supported, process and compare to ~/.face
         else:
-            image = self.accounts_service.get_icon_file()
+            image = as_props['IconFile']
             logger.debug('Found profile image: %s' % str(image))
 
             if os.path.isfile(face):
+                handle = imaging.ImageHandle(face)
                 try:
                     if os.path.samefile(image, face):
-                        self.updated_image = face
+                        self.updated_image = handle
                     else:
                         self.updated_image = None
                 except FileNotFoundError:
                     self.updated_image = None
-                self.set_user_image(face)
+                self.set_user_image(handle)
             elif os.path.isfile(image):
-                self.updated_image = image
-                self.set_user_image(image)
+                self.updated_image = imaging.ImageHandle(image)
+                self.set_user_image(self.updated_image)
             else:
                 self.updated_image = None
                 self.set_user_image(None)
 
-        user_details = self.get_user_details()
+        user_details = self.get_user_details(as_props)
 
         # Set the class variables
         self.first_name = user_details['first_name']
@@ -298,22 +433,21 @@ class MugshotWindow(Window):
         self.email_entry.set_text(self.email)
         self.fax_entry.set_text(self.fax)
 
+        self.apply_button.set_sensitive(True)
+
     # = Mugshot Window ====================================================== #
-    def set_user_image(self, filename=None):
-        """Scale and set the user profile image."""
-        logger.debug("Setting user profile image to %s" % str(filename))
-        if filename and os.path.exists(filename):
-            try:
-                pixbuf = GdkPixbuf.Pixbuf.new_from_file(filename)
-                scaled = pixbuf.scale_simple(128, 128,
-                                             GdkPixbuf.InterpType.HYPER)
+    def set_user_image(self, image=None):
+        """Scale and set the user profile image from an ImageHandle."""
+        logger.debug("Setting user profile image to %s" %
+                     str(image and image.get_filename()))
+        if image is not None and not image.is_empty():
+            scaled = image.get_scaled_pixbuf(128, 128)
+            if scaled is not None:
                 self.user_image.set_from_pixbuf(scaled)
                 # Show "Remove" menu item.
                 self.menuitem1.set_visible(True)
                 self.image_remove.set_visible(True)
                 return
-            except GLib.Error:  # pylint: disable=E0712
-                pass
 
         self.user_image.set_from_icon_name('avatar-default', 128)
         # Hide "Remove" menu item.
@@ -366,16 +500,28 @@ class MugshotWindow(Window):
                 dialog.destroy()
                 return
 
-        if self.get_as_details_updated():
-            self.save_as_details()
+        self.apply_button.set_sensitive(False)
+
+        # Install the profile image first, then register it with
+        # AccountsService together with the other details.
+        image = self.save_image()
+        self.save_as_details(self.on_as_details_saved, image)
+
+    def on_as_details_saved(self, results):
+        """Continue applying changes once AccountsService has been updated."""
+        for key, success in results.items():
+            if not success:
+                logger.warning('Unable to save %s to AccountsService.' % key)
+        self.finish_apply()
 
+    def finish_apply(self):
+        """Commit the remaining changes and close the window."""
         if self.get_libreoffice_details_updated():
             self.set_libreoffice_data()
 
-        if self.updated_image is not None:
-            self.save_image()
-
         self.save_gsettings()
+        logger.debug('AccountsService cache: %s' %
+                     self.accounts_service.get_cache_stats())
         self.destroy()
 
     def save_gsettings(self):
@@ -406,48 +552,88 @@ class MugshotWindow(Window):
         logger.debug('Cancel clicked, goodbye.')
         self.destroy()
 
+    def on_destroy(self, widget, data=None):
+        """Stop waiting for AccountsService and stop loading thumbnails when
+        the window is closed."""
+        self.accounts_service_cancellable.cancel()
+        if self.stock_cancel is not None:
+            self.stock_cancel.set()
+        if self.stock_executor is not None:
+            self.stock_executor.shutdown(wait=False)
+        super(MugshotWindow, self).on_destroy(widget, data)
+
     def on_image_remove_activate(self, widget):
         """Remove the user's profile image."""
-        self.updated_image = ""
+        self.updated_image = imaging.ImageHandle()
         self.set_user_image(None)
 
+    def prewarm_camera_dialog(self):
+        """Create the camera dialog in the background once the window is
+        drawn, so the camera starts quickly when it is first shown."""
+        if self.camera_dialog is None:
+            logger.debug('Pre-warming the camera')
+            self.create_camera_dialog()
+            self.camera_dialog.prewarm()
+        return False
+
     def on_camera_dialog_apply(self, widget, data=None):
-        """Commit changes when apply is clicked."""
+        """Commit changes when apply is clicked. data is the ImageHandle of
+        the captured photo."""
         self.updated_image = data
         self.set_user_image(data)
 
     def save_image(self):
-        """Copy the updated image filename to ~/.face"""
+        """Write the updated image to ~/.face
+
+        Return the image filename to register with AccountsService, or None if
+        the image has not been updated or could not be saved."""
         # Check if the image has been updated.
         if self.updated_image is None:
             logger.debug('Photo not updated, not saving changes.')
-            return False
-
-        if not os.path.isfile(self.updated_image):
-            self.updated_image = ""
+            return None
 
         face = os.path.join(home, '.face')
+        image = ""
+        filename = self.updated_image.get_filename()
 
-        if os.path.normpath(face) != os.path.normpath(self.updated_image):
-            # If the .face file already exists, remove it first.
+        if filename is not None and os.path.isfile(face) and \
+                os.path.normpath(face) == os.path.normpath(filename):
+            image = face
+        elif not self.updated_image.is_empty():
             logger.debug('Photo updated, saving ~/.face profile image.')
-            if os.path.isfile(face):
-                os.remove(face)
-            # Copy the new file to ~/.face
-            if os.path.isfile(self.updated_image):
-                shutil.copyfile(self.updated_image, face)
-
-        # Update AccountsService profile image
-        if self.accounts_service.available():
-            logger.debug(
-                'Photo updated, saving AccountsService profile image.')
-            self.accounts_service.set_icon_file(self.updated_image)
+            # Atomically replace ~/.face with the new image, scaling it down
+            # if needed.
+            if not self.install_image(self.updated_image, face):
+                # Keep the current ~/.face and IconFile rather than clearing
+                # them.
+                logger.warning('Unable to save ~/.face profile image, '
+                               'keeping the current image.')
+                return None
+            image = face
+
+        # The image was removed.
+        if image == "" and os.path.isfile(face):
+            os.remove(face)
 
         # Update Pidgin buddy icon
-        self.set_pidgin_buddyicon(self.updated_image)
+        self.set_pidgin_buddyicon(image)
 
         self.updated_image = None
-        return True
+        return image
+
+    def install_image(self, image, target):
+        """Write a size-bounded copy of the ImageHandle to target using the
+        profile image settings. Return False if it cannot be loaded."""
+        installed = image.install(
+            target,
+            self.settings.get_int('avatar-max-size'),
+            self.settings.get_string('avatar-format'),
+            self.settings.get_int('avatar-compression'),
+            self.settings.get_int('avatar-quality'))
+        if installed:
+            logger.debug('Installed profile image: %i bytes' %
+                         os.path.getsize(target))
+        return installed
 
     def set_pidgin_buddyicon(self, filename=None):
         """Sets the pidgin buddyicon to filename (usually ~/.face).
@@ -516,17 +702,27 @@ class MugshotWindow(Window):
             return True
         return False
 
-    def save_as_details(self):
-        if not self.accounts_service.available():
-            return True
-        first_name = get_entry_value(self.first_name_entry)
-        last_name = get_entry_value(self.last_name_entry)
-        full_name = "%s %s" % (first_name, last_name)
-        full_name = full_name.strip()
-        email = get_entry_value(self.email_entry)
-        self.accounts_service.set_real_name(full_name)
-        self.accounts_service.set_email(email)
-        return True
+    def save_as_details(self, callback, icon_file=None):
+        """Asynchronously save the name, email and profile image (if not None)
+        to AccountsService in a single batch, then pass the per-property
+        results to callback."""
+        changes = {}
+        if self.get_as_details_updated():
+            first_name = get_entry_value(self.first_name_entry)
+            last_name = get_entry_value(self.last_name_entry)
+            full_name = "%s %s" % (first_name, last_name)
+            changes['RealName'] = full_name.strip()
+            changes['Email'] = get_entry_value(self.email_entry)
+        if icon_file is not None and self.accounts_service.available():
+            logger.debug(
+                'Photo updated, saving AccountsService profile image.')
+            changes['IconFile'] = icon_file
+
+        if len(changes) == 0:
+            callback({})
+            return
+
+        self.accounts_service.set_properties_async(changes, callback)
 
     def get_chfn_details_updated(self):
         """Return True if chfn-related details have been modified."""
@@ -662,14 +858,14 @@ class MugshotWindow(Window):
         logger.debug('LibreOffice details do not need to be updated.')
         return False
 
-    def get_user_details(self):
+    def get_user_details(self, as_props=None):
         """Use the various methods to get the most up-to-date version of the
         user details."""
         # Start with LibreOffice, as users may have configured that first.
         data = self.get_libreoffice_data()
 
         # Prefer AccountsService, GLib, then passwd
-        as_data = self.get_accounts_service_data()
+        as_data = self.get_accounts_service_data(as_props)
         gl_data = self.get_glib_data()
         pwd_data = self.get_passwd_data()
 
@@ -716,17 +912,19 @@ class MugshotWindow(Window):
             "first": first, "last": last, "initials": initials
         }
 
-    def get_accounts_service_data(self):
+    def get_accounts_service_data(self, as_props=None):
         if not self.accounts_service.available():
             return None
+        if as_props is None:
+            return None
 
-        name = self.accounts_service.get_real_name()
+        name = as_props['RealName']
         if name:
             name = self.split_name(name)
         else:
             name = {'first': '', 'last': '', 'initials': ''}
 
-        email = self.accounts_service.get_email()
+        email = as_props['Email']
         if not email:
             email = ''
 
@@ -976,22 +1174,85 @@ class MugshotWindow(Window):
         self.stock_browser.show_all()
 
     def load_stock_browser(self):
-        """Load the stock photo browser."""
-        # Check if the photos have already been loaded.
+        """Load the stock photo browser.
+
+        Every photo is listed immediately with a placeholder image, and the
+        thumbnails are decoded in a thread pool and filled in as they
+        finish."""
         model = self.iconview.get_model()
-        if len(model) != 0:
+
+        # If they have not been listed, list each photo from faces_dir.
+        if len(model) == 0:
+            logger.debug("Loading stock browser photos.")
+            placeholder = self.get_stock_placeholder()
+            for filename in os.listdir(faces_dir):
+                full_path = os.path.join(faces_dir, filename)
+                if os.path.isfile(full_path):
+                    model.append([full_path, placeholder])
+
+        # Resume any thumbnails still queued from the last time the browser
+        # was shown.
+        if self.stock_cancel is None:
+            self.stock_cancel = threading.Event()
+        self.stock_cancel.clear()
+
+        # Check if the photos have already been loaded or are loading.
+        pending = [(index, row[0]) for index, row in enumerate(model)
+                   if row[0] not in self.stock_thumbnails and
+                   row[0] not in self.stock_loading]
+        if len(pending) == 0:
             logger.debug("Stock browser already loaded.")
             return
 
-        # If they have not, load each photo from faces_dir.
-        logger.debug("Loading stock browser photos.")
-        for filename in os.listdir(faces_dir):
-            full_path = os.path.join(faces_dir, filename)
-            if os.path.isfile(full_path):
-                pixbuf = GdkPixbuf.Pixbuf.new_from_file(full_path)
-                scaled = pixbuf.scale_simple(90, 90,
-                                             GdkPixbuf.InterpType.HYPER)
-                model.append([full_path, scaled])
+        logger.debug("Loading %i stock browser thumbnails." % len(pending))
+        for index, filename in pending:
+            self.submit_stock_thumbnail(index, filename)
+
+    def submit_stock_thumbnail(self, index, filename):
+        """Decode a stock photo thumbnail in the thread pool."""
+        if self.stock_executor is None:
+            self.stock_executor = ThreadPoolExecutor(
+                max_workers=stock_thumbnail_workers)
+        self.stock_loading.add(filename)
+        self.stock_executor.submit(self.load_stock_thumbnail, index,
+                                   filename, self.stock_cancel)
+
+    def get_stock_placeholder(self):
+        """Return the placeholder shown while a thumbnail is loading."""
+        try:
+            return Gtk.IconTheme.get_default().load_icon(
+                'avatar-default', 90, Gtk.IconLoadFlags.FORCE_SIZE)
+        except GLib.Error:  # pylint: disable=E0712
+            return None
+
+    def load_stock_thumbnail(self, index, filename, cancel):
+        """Decode a stock photo thumbnail. Called from a worker thread."""
+        if cancel.is_set():
+            GLib.idle_add(self.skip_stock_thumbnail, index, filename)
+            return
+        pixbuf = helpers.get_thumbnail_pixbuf(filename, 90, 90)
+        GLib.idle_add(self.set_stock_thumbnail, index, filename, pixbuf)
+
+    def skip_stock_thumbnail(self, index, filename):
+        """Forget a thumbnail skipped while the browser was hidden, loading
+        it again if the browser has been shown since."""
+        self.stock_loading.discard(filename)
+        if not self.stock_cancel.is_set():
+            self.submit_stock_thumbnail(index, filename)
+        return False
+
+    def set_stock_thumbnail(self, index, filename, pixbuf):
+        """Show a decoded stock photo thumbnail."""
+        self.stock_loading.discard(filename)
+        self.stock_thumbnails.add(filename)
+        if pixbuf is not None:
+            self.iconview.get_model()[index][1] = pixbuf
+        return False
+
+    def on_stock_browser_hide(self, widget):
+        """Stop decoding thumbnails when the stock browser is hidden."""
+        if self.stock_cancel is not None:
+            self.stock_cancel.set()
 
     def on_stock_iconview_selection_changed(self, widget):
         """Enable stock submission only when an item is selected."""
@@ -1019,8 +1280,8 @@ class MugshotWindow(Window):
             logger.debug("Selected %s" % filename)
 
             # Update variables and widgets, then hide.
-            self.set_user_image(filename)
-            self.updated_image = filename
+            self.updated_image = imaging.ImageHandle(filename)
+            self.set_user_image(self.updated_image)
             self.stock_browser.hide()
 
     def on_stock_iconview_item_activated(self, widget, path):
@@ -1033,139 +1294,142 @@ class MugshotWindow(Window):
         # Run the dialog, grab the filename if confirmed, then hide the dialog.
         response = self.chooser.run()
         if response == Gtk.ResponseType.APPLY:
-            # Update the user image, store the path for committing later.
-            self.updated_image = helpers.new_tempfile('browse')
-            self.filechooser_preview_pixbuf.savev(self.updated_image, "png",
-                                                  [], [])
-            logger.debug("Selected %s" % self.updated_image)
-            self.set_user_image(self.updated_image)
+            # Make sure the preview reflects the final crop settings.
+            self.flush_preview_render()
+            # Crop the full resolution image, keep it in memory for
+            # committing later.
+            pixbuf = self.get_filechooser_pixbuf()
+            if pixbuf is not None:
+                # Copy the crop so the full resolution image is released.
+                self.updated_image = imaging.ImageHandle(pixbuf=pixbuf.copy())
+                logger.debug("Selected %s" % self.chooser.get_filename())
+                self.set_user_image(self.updated_image)
         self.chooser.hide()
+        self.cancel_preview_render()
+        self.preview_cache.clear()
 
     def on_filechooserdialog_update_preview(self, widget):
         """Update the preview image used in the file chooser."""
+        self.queue_preview_render()
+
+    def queue_preview_render(self):
+        """Schedule a preview render once pending events are processed.
+
+        Bursts of selection, zoom, crop and spin changes collapse into a
+        single render, which always reads the latest widget state."""
+        if self.preview_render_source is None:
+            self.preview_render_source = GLib.idle_add(
+                self.on_preview_render_idle)
+
+    def cancel_preview_render(self):
+        """Drop any scheduled preview render."""
+        if self.preview_render_source is not None:
+            GLib.source_remove(self.preview_render_source)
+            self.preview_render_source = None
+        self.filechooser_crop = None
+
+    def flush_preview_render(self):
+        """Run a scheduled preview render immediately."""
+        if self.preview_render_source is not None:
+            self.cancel_preview_render()
+            self.render_filechooser_preview()
+
+    def on_preview_render_idle(self):
+        self.preview_render_source = None
+        self.filechooser_crop = None
+        self.render_filechooser_preview()
+        return False
+
+    def render_filechooser_preview(self):
+        """Render the preview image used in the file chooser."""
         # Set x&y spin button's default to non-editable
         self.x_spin_button.set_editable(False)
         self.y_spin_button.set_editable(False)
+        self.filechooser_crop = None
 
-        filename = widget.get_filename()
+        filename = self.chooser.get_filename()
         if not filename:
             self.file_chooser_preview.set_from_icon_name('folder', 128)
             return
         if not os.path.isfile(filename):
             self.file_chooser_preview.set_from_icon_name('folder', 128)
             return
-        filechooser_pixbuf = GdkPixbuf.Pixbuf.new_from_file(filename)
-
-        # Get the image dimensions.
-        height = filechooser_pixbuf.get_height()
-        width = filechooser_pixbuf.get_width()
-        
-        # When zoomed.
-        # Get zoom value.
-        zoom_scale_min = self.zoom_scale.get_adjustment().get_lower() # Min zoom value
-        zoom_scale_value = self.zoom_scale.get_adjustment().get_value() # Current zoom value
-        zoom_scale_value = zoom_scale_value - zoom_scale_min
-
-        # Set maximum scale value to the width or height of the picture.
-        if width > height:
-            self.zoom_scale.get_adjustment().set_upper(height)
-        else:
-            self.zoom_scale.get_adjustment().set_upper(width)
-
-        # Minus height or width with current zoom value.
-        height = height - zoom_scale_value
-        width = width - zoom_scale_value
-
-        # Set crop area to the center of picture.
-        start_x = zoom_scale_value / 2
-        start_y = start_x
- 
-        # Coordinate for circle's center.
-        center_x = start_x + width / 2
-        center_y = start_y + height / 2
-
-        if self.crop_center.get_active():
-            # Calculate a balanced center.
-            if width > height:
-                start_x = (width - height) / 2 + start_x
-                width = height
-            else:
-                start_y = (height - width) / 2 + start_y
-                height = width
-
-            self.x_spin_button.get_adjustment().set_value(start_x)
-            self.y_spin_button.get_adjustment().set_value(start_y)
-
-        elif self.crop_left.get_active():
-            if width > height:
-                width = height
-            else:
-                start_y = (height - width) / 2 + start_y
-                height = width
+        # The source dimensions define the crop geometry, but the interactive
+        # preview is rendered from a small proxy of the image.
+        file_format, width, height = GdkPixbuf.Pixbuf.get_file_info(filename)
+        proxy = self.preview_cache.get(filename, preview_proxy_size)
+        if file_format is None or proxy is None:
+            self.file_chooser_preview.set_from_icon_name('image-missing', 128)
+            return
 
-            start_x = 0
-            center_x = start_x + width / 2
+        crop = self.get_crop_geometry(width, height)
+        self.filechooser_crop = (filename, crop, self.circle.get_active())
+
+        proxy_crop = imaging.scale_crop_rectangle(crop,
+                                                  proxy.get_width() / width,
+                                                  proxy.get_width(),
+                                                  proxy.get_height())
+        preview_pixbuf = imaging.crop_pixbuf(proxy, proxy_crop,
+                                             self.circle.get_active())
+        scaled = preview_pixbuf.scale_simple(128, 128,
+                                             GdkPixbuf.InterpType.BILINEAR)
+        self.file_chooser_preview.set_from_pixbuf(scaled)
 
-            self.x_spin_button.get_adjustment().set_value(start_x)
-            self.y_spin_button.get_adjustment().set_value(start_y)
+    def get_filechooser_pixbuf(self):
+        """Return the full resolution crop of the current chooser image, or
+        None if no image is selected."""
+        if self.filechooser_crop is None:
+            # The chooser was reopened without a new preview, so compute the
+            # crop of the current selection now.
+            self.render_filechooser_preview()
+        if self.filechooser_crop is None:
+            return None
+        filename, crop, circle = self.filechooser_crop
+        try:
+            pixbuf = GdkPixbuf.Pixbuf.new_from_file(filename)
+        except GLib.Error:  # pylint: disable=E0712
+            return None
+        return imaging.crop_pixbuf(pixbuf, crop, circle)
 
+    def get_crop_geometry(self, width, height):
+        """Return the (x, y, width, height) crop rectangle of an image with the
+        specified dimensions for the current zoom and crop settings."""
+        if self.crop_left.get_active():
+            mode = imaging.CROP_LEFT
         elif self.crop_right.get_active():
-            if width > height:
-                start_x = (width - height) + zoom_scale_value
-                width = height
-            else:
-                start_x = zoom_scale_value
-                start_y = (height - width) / 2 + start_y
-                height = width
+            mode = imaging.CROP_RIGHT
+        elif self.crop_manual.get_active():
+            mode = imaging.CROP_MANUAL
+        else:
+            mode = imaging.CROP_CENTER
 
-            center_x = start_x + width / 2
+        # Get zoom value.
+        zoom_adjustment = self.zoom_scale.get_adjustment()
+        zoom = zoom_adjustment.get_value() - zoom_adjustment.get_lower()
 
-            self.x_spin_button.get_adjustment().set_value(start_x)
-            self.y_spin_button.get_adjustment().set_value(start_y)
+        # Set maximum scale value to the width or height of the picture.
+        zoom_adjustment.set_upper(imaging.get_zoom_range(width, height))
 
-        elif self.crop_manual.get_active():
+        x_adjustment = self.x_spin_button.get_adjustment()
+        y_adjustment = self.y_spin_button.get_adjustment()
+        if mode == imaging.CROP_MANUAL:
             self.x_spin_button.set_editable(True)
             self.y_spin_button.set_editable(True)
-            if width > height:
-                self.x_spin_button.get_adjustment().set_upper(width - height + zoom_scale_value)
-                self.y_spin_button.get_adjustment().set_upper(zoom_scale_value)
-                width = height
-            else:
-                self.x_spin_button.get_adjustment().set_upper(zoom_scale_value)
-                self.y_spin_button.get_adjustment().set_upper(height - width + zoom_scale_value)
-                height = width
-
-            start_x = self.x_spin_button.get_adjustment().get_value()
-            start_y = self.y_spin_button.get_adjustment().get_value()
-            center_x = start_x + width / 2
-            center_y = start_y + height / 2
-
-        # Create a new cropped pixbuf.
-        if self.circle.get_active(): # Create a Circle Crop
-            surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, 
-                filechooser_pixbuf.get_width(), filechooser_pixbuf.get_height())
-            context = cairo.Context(surface)
-            
-            context.arc(center_x, center_y, width/2, 0, 2*22/7)
-            context.clip()    
-            context.new_path()
-
-            image_cairo = \
-                Gdk.cairo_surface_create_from_pixbuf(filechooser_pixbuf, 0)
-            context.set_source_surface(image_cairo, 0, 0)
-            context.paint()
-
-            self.filechooser_preview_pixbuf = \
-                Gdk.pixbuf_get_from_surface(surface, start_x, start_y, width, height)
-        else:
-            self.filechooser_preview_pixbuf = \
-                filechooser_pixbuf.new_subpixbuf(start_x, start_y, width, height)   # Create a square crop
+            x_upper, y_upper = imaging.get_manual_crop_range(width, height,
+                                                             zoom)
+            x_adjustment.set_upper(x_upper)
+            y_adjustment.set_upper(y_upper)
 
-        scaled = self.filechooser_preview_pixbuf.scale_simple(
-            128, 128,
-            GdkPixbuf.InterpType.HYPER)
-        self.file_chooser_preview.set_from_pixbuf(scaled)
+        crop = imaging.get_crop_rectangle(width, height, mode, zoom,
+                                          x_adjustment.get_value(),
+                                          y_adjustment.get_value())
+
+        if mode != imaging.CROP_MANUAL:
+            x_adjustment.set_value(crop[0])
+            y_adjustment.set_value(crop[1])
+
+        return crop
 
     def on_crop_changed(self, widget, data=None):
         """Update the preview image when crop style is modified."""
-        self.on_filechooserdialog_update_preview(self.chooser)
+        self.queue_preview_render()
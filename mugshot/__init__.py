@@ -34,17 +34,25 @@ def parse_options():
     parser.add_argument(
         "-v", "--verbose", action="count", dest="verbose",
         help=_("Show debug messages (-vv debugs mugshot_lib also)"))
+    parser.add_argument(
+        "--admin", action="store_true", dest="admin",
+        help=_("Manage the profile image and details of all users"))
     options = parser.parse_args()
 
     set_up_logging(options)
+    return options
 
 
 def main():
     'constructor for your class instances'
-    parse_options()
+    options = parse_options()
 
     # Run the application.
-    window = MugshotWindow.MugshotWindow()
+    if options.admin:
+        from mugshot import MugshotAdminWindow
+        window = MugshotAdminWindow.MugshotAdminWindow()
+    else:
+        window = MugshotWindow.MugshotWindow()
     window.show()
 
     # Allow application shutdown with Ctrl-C in terminal
@@ -19,6 +19,84 @@
 from gi.repository import Gio, GLib
 
 
+def idle_callback(callback, *args):
+    """Invoke callback(*args) once from the main loop."""
+    def dispatch():
+        callback(*args)
+        return False
+    GLib.idle_add(dispatch)
+
+
+def call_async(bus, path, interface, method, variant, reply_type, callback,
+               cancellable, timeout):
+    """Call an AccountsService method, passing the unpacked reply or None to
+    callback."""
+    def on_reply(source, result):
+        try:
+            reply = source.call_finish(result).unpack()
+        except GLib.Error:
+            reply = None
+        callback(reply)
+
+    bus.call('org.freedesktop.Accounts', path, interface, method,
+             variant, GLib.VariantType.new(reply_type),
+             Gio.DBusCallFlags.NONE, timeout, cancellable, on_reply)
+
+
+def get_cached_users_async(user_callback, done_callback=None,
+                           cancellable=None, timeout=-1):
+    """Asynchronously enumerate every user known to AccountsService.
+
+    ListCachedUsers is called once, then the properties of all users are
+    fetched with concurrent GetAll calls. user_callback(path, props) is
+    invoked from the main loop as each user arrives, and done_callback(count)
+    once every user has been processed. No user needs to be looked up first,
+    so nothing here blocks on D-Bus."""
+    state = {"pending": 0, "count": 0}
+
+    def finish():
+        if done_callback is not None:
+            done_callback(state["count"])
+
+    def on_properties(path, reply):
+        state["pending"] -= 1
+        if reply is not None:
+            (props,) = reply
+            state["count"] += 1
+            user_callback(path, props)
+        if state["pending"] == 0:
+            finish()
+
+    def on_users(bus, reply):
+        if reply is None:
+            finish()
+            return
+        (paths,) = reply
+        if len(paths) == 0:
+            finish()
+            return
+        state["pending"] = len(paths)
+        variant = GLib.Variant('(s)', ('org.freedesktop.Accounts.User',))
+        for path in paths:
+            call_async(bus, path, 'org.freedesktop.DBus.Properties', 'GetAll',
+                       variant, '(a{sv})',
+                       lambda reply, path=path: on_properties(path, reply),
+                       cancellable, timeout)
+
+    def on_bus_ready(source, result):
+        try:
+            bus = Gio.bus_get_finish(result)
+        except GLib.Error:
+            finish()
+            return
+        call_async(bus, '/org/freedesktop/Accounts',
+                   'org.freedesktop.Accounts', 'ListCachedUsers', None,
+                   '(ao)', lambda reply: on_users(bus, reply),
+                   cancellable, timeout)
+
+    Gio.bus_get(Gio.BusType.SYSTEM, cancellable, on_bus_ready)
+
+
 class MugshotAccountsServiceAdapter:
 
     _properties = {
@@ -43,18 +121,73 @@ class MugshotAccountsServiceAdapter:
         "CredentialLifetime": int
     }
 
-    def __init__(self, username):
+    def __init__(self, username, cached=False, timeout=-1, path=None,
+                 resolve=True):
+        """Create an adapter for username.
+
+        In cached mode, a single bus connection and object path are kept for
+        the lifetime of the adapter, and user properties are served from a
+        snapshot that is only refreshed after AccountsService reports a
+        change.
+
+        timeout is the default deadline for D-Bus calls in milliseconds,
+        -1 uses the D-Bus default.
+
+        path may be given when the user object path is already known, such
+        as from ListCachedUsers, to skip the FindUserByName lookup.
+
+        If resolve is False, the user is not looked up here and available()
+        returns False until resolve_async() completes, so the constructor
+        never blocks on D-Bus."""
         self._set_username(username)
+        self._cached = cached
+        self._timeout = timeout
+        self._bus = None
+        self._path = path
+        self._props = None
+        self._subscriptions = []
+        self.cache_hits = 0
+        self.cache_misses = 0
         self._available = False
+        if not resolve:
+            return
         try:
             self._get_path()
             self._available = True
         except:
             pass
+        if self._cached and self._available:
+            self._subscribe()
 
     def available(self):
         return self._available
 
+    def get_cache_stats(self):
+        """Return the number of property cache hits and misses."""
+        return {"hits": self.cache_hits, "misses": self.cache_misses}
+
+    def _subscribe(self):
+        """Invalidate the property snapshot when the user is modified."""
+        bus = self._get_bus()
+        if bus is None:
+            return
+        for interface, member in [
+                ('org.freedesktop.DBus.Properties', 'PropertiesChanged'),
+                ('org.freedesktop.Accounts.User', 'Changed')]:
+            subscription = bus.signal_subscribe('org.freedesktop.Accounts',
+                                                interface, member,
+                                                self._path, None,
+                                                Gio.DBusSignalFlags.NONE,
+                                                self._on_user_changed, None)
+            self._subscriptions.append(subscription)
+
+    def _on_user_changed(self, connection, sender, path, interface, signal,
+                         parameters, user_data=None):
+        self._invalidate()
+
+    def _invalidate(self):
+        self._props = None
+
     def _set_username(self, username):
         self._username = username
 
@@ -62,7 +195,12 @@ class MugshotAccountsServiceAdapter:
         return self._username
 
     def _get_path(self):
-        return self._find_user_by_name(self._username)
+        if self._path is None:
+            path = self._find_user_by_name(self._username)
+            if not self._cached:
+                return path
+            self._path = path
+        return self._path
 
     def _get_variant(self, vtype, value):
         if vtype == bool:
@@ -90,7 +228,8 @@ class MugshotAccountsServiceAdapter:
                           method, variant,
                           GLib.VariantType.new('()'),
                           Gio.DBusCallFlags.NONE,
-                          -1, None)
+                          self._timeout, None)
+            self._invalidate()
             return True
         except:
             return False
@@ -108,27 +247,41 @@ class MugshotAccountsServiceAdapter:
                                    variant,
                                    GLib.VariantType.new('(a{sv})'),
                                    Gio.DBusCallFlags.NONE,
-                                   -1,
+                                   self._timeout,
                                    None)
             (props,) = result.unpack()
             return props
         except:
             return None
 
+    def _get_properties(self):
+        if not self._cached:
+            return self._get_all()
+        if self._props is not None:
+            self.cache_hits += 1
+            return self._props
+        self.cache_misses += 1
+        self._props = self._get_all()
+        return self._props
+
     def _get_property(self, key):
         if key not in list(self._properties.keys()):
             return False
-        props = self._get_all()
+        props = self._get_properties()
         if props is not None:
             return props[key]
         return False
 
     def _get_bus(self):
+        if self._bus is not None:
+            return self._bus
         try:
             bus = Gio.bus_get_sync(Gio.BusType.SYSTEM, None)
-            return bus
         except:
             return None
+        if self._cached:
+            self._bus = bus
+        return bus
 
     def _find_user_by_name(self, username):
         try:
@@ -140,13 +293,220 @@ class MugshotAccountsServiceAdapter:
                                    GLib.Variant('(s)', (username,)),
                                    GLib.VariantType.new('(o)'),
                                    Gio.DBusCallFlags.NONE,
-                                   -1,
+                                   self._timeout,
                                    None)
             (path,) = result.unpack()
             return path
         except:
             return None
 
+    # = Asynchronous API ================================================== #
+    def _get_timeout(self, timeout):
+        if timeout is None:
+            return self._timeout
+        return timeout
+
+    def _get_bus_async(self, callback, cancellable):
+        """Pass the system bus, or None if unavailable, to callback."""
+        if self._bus is not None:
+            callback(self._bus)
+            return
+
+        def on_bus_ready(source, result):
+            try:
+                bus = Gio.bus_get_finish(result)
+            except GLib.Error:
+                bus = None
+            if self._cached and bus is not None:
+                self._bus = bus
+            callback(bus)
+
+        Gio.bus_get(Gio.BusType.SYSTEM, cancellable, on_bus_ready)
+
+    def resolve_async(self, callback, cancellable=None, timeout=None):
+        """Asynchronously look up the user object path.
+
+        callback(available) is invoked from the main loop with True if the
+        user was found, or False if AccountsService is unavailable, timed
+        out or the call was cancelled."""
+        def on_path_ready(bus, path):
+            self._available = path is not None
+            if self._available:
+                self._path = path
+                if self._cached:
+                    self._subscribe()
+            callback(self._available)
+
+        self._get_path_async(on_path_ready, cancellable,
+                             self._get_timeout(timeout))
+
+    def _get_path_async(self, callback, cancellable, timeout):
+        """Pass the bus and user object path, or (None, None), to callback."""
+        def on_user_found(bus, reply):
+            if reply is None:
+                callback(None, None)
+                return
+            (path,) = reply
+            if self._cached:
+                self._path = path
+            callback(bus, path)
+
+        def on_bus_ready(bus):
+            if bus is None:
+                callback(None, None)
+            elif self._path is not None:
+                callback(bus, self._path)
+            else:
+                call_async(bus, '/org/freedesktop/Accounts',
+                           'org.freedesktop.Accounts',
+                           'FindUserByName',
+                           GLib.Variant('(s)', (self._username,)),
+                           '(o)',
+                           lambda reply: on_user_found(bus, reply),
+                           cancellable, timeout)
+
+        self._get_bus_async(on_bus_ready, cancellable)
+
+    def get_properties_async(self, callback, cancellable=None, timeout=None):
+        """Asynchronously get all user properties.
+
+        callback(props) is invoked from the main loop with a dict of
+        properties, or None if the call failed, timed out or was cancelled.
+        timeout overrides the default deadline in milliseconds."""
+        timeout = self._get_timeout(timeout)
+
+        if self._cached and self._props is not None:
+            self.cache_hits += 1
+            idle_callback(callback, self._props)
+            return
+
+        def on_properties(reply):
+            if reply is None:
+                callback(None)
+                return
+            (props,) = reply
+            if self._cached:
+                self.cache_misses += 1
+                self._props = props
+            callback(props)
+
+        def on_path_ready(bus, path):
+            if path is None:
+                callback(None)
+                return
+            call_async(bus, path, 'org.freedesktop.DBus.Properties',
+                       'GetAll',
+                       GLib.Variant('(s)',
+                                    ('org.freedesktop.Accounts.User',)),
+                       '(a{sv})', on_properties, cancellable, timeout)
+
+        self._get_path_async(on_path_ready, cancellable, timeout)
+
+    def _get_property_async(self, key, callback, cancellable, timeout):
+        if key not in list(self._properties.keys()):
+            idle_callback(callback, False)
+            return
+
+        def on_properties(props):
+            if props is None:
+                callback(False)
+            else:
+                callback(props[key])
+
+        self.get_properties_async(on_properties, cancellable, timeout)
+
+    def set_properties_async(self, changes, callback=None, cancellable=None,
+                             timeout=None):
+        """Asynchronously set several user properties at once.
+
+        changes maps property names (e.g. "RealName") to their new values.
+        The user path is resolved once and every Set* call is dispatched
+        concurrently on the same connection, so a batch costs a single
+        round trip. callback(results) is invoked from the main loop with a
+        dict mapping each property to True on success."""
+        timeout = self._get_timeout(timeout)
+        results = {}
+        pending = {}
+        for key, value in changes.items():
+            if key in list(self._properties.keys()):
+                pending[key] = self._get_variant(self._properties[key], value)
+            else:
+                results[key] = False
+
+        def finish():
+            self._invalidate()
+            if callback is not None:
+                callback(results)
+
+        if len(pending) == 0:
+            idle_callback(finish)
+            return
+
+        def on_reply(key, reply):
+            results[key] = reply is not None
+            if len(results) == len(changes):
+                finish()
+
+        def on_path_ready(bus, path):
+            if path is None:
+                for key in pending.keys():
+                    results[key] = False
+                finish()
+                return
+            for key, variant in pending.items():
+                call_async(bus, path, 'org.freedesktop.Accounts.User',
+                           "Set" + key, variant, '()',
+                           lambda reply, key=key: on_reply(key, reply),
+                           cancellable, timeout)
+
+        self._get_path_async(on_path_ready, cancellable, timeout)
+
+    def _set_property_async(self, key, value, callback, cancellable,
+                            timeout):
+        """Asynchronously set a user property, then pass True on success or
+        False on failure to callback (if not None)."""
+        def on_results(results):
+            if callback is not None:
+                callback(results[key])
+
+        self.set_properties_async({key: value}, on_results, cancellable,
+                                  timeout)
+
+    def get_email_async(self, callback, cancellable=None, timeout=None):
+        self._get_property_async("Email", callback, cancellable, timeout)
+
+    def set_email_async(self, email, callback=None, cancellable=None,
+                        timeout=None):
+        self._set_property_async("Email", email, callback, cancellable,
+                                 timeout)
+
+    def get_location_async(self, callback, cancellable=None, timeout=None):
+        self._get_property_async("Location", callback, cancellable, timeout)
+
+    def set_location_async(self, location, callback=None, cancellable=None,
+                           timeout=None):
+        self._set_property_async("Location", location, callback,
+                                 cancellable, timeout)
+
+    def get_icon_file_async(self, callback, cancellable=None, timeout=None):
+        """Asynchronously get user profile image using AccountsService."""
+        self._get_property_async("IconFile", callback, cancellable, timeout)
+
+    def set_icon_file_async(self, filename, callback=None, cancellable=None,
+                            timeout=None):
+        """Asynchronously set user profile image using AccountsService."""
+        self._set_property_async("IconFile", filename, callback,
+                                 cancellable, timeout)
+
+    def get_real_name_async(self, callback, cancellable=None, timeout=None):
+        self._get_property_async("RealName", callback, cancellable, timeout)
+
+    def set_real_name_async(self, name, callback=None, cancellable=None,
+                            timeout=None):
+        self._set_property_async("RealName", name, callback, cancellable,
+                                 timeout)
+
+    # = Synchronous API ===================================================== #
     def get_email(self):
         return self._get_property("Email")
 
@@ -17,9 +17,10 @@
 #   with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import threading
 from locale import gettext as _
 
-from gi.repository import Gtk, GdkPixbuf
+from gi.repository import Gtk, GdkPixbuf, GLib
 
 import pexpect
 
@@ -36,9 +37,62 @@ def check_gtk_version(major_version, minor_version, micro=0):
 # Check if the LANG variable needs to be set
 use_env = False
 
+# Dependency checks are memoized for the lifetime of the process.
+dependency_results = {}
+dependency_callbacks = {}
+dependency_lock = threading.Lock()
+
 
 def check_dependencies(commands=[]):
     """Check for the existence of required commands, and sudo access"""
+    key = tuple(commands)
+    with dependency_lock:
+        if key in dependency_results:
+            return dependency_results[key]
+    result = probe_dependencies(commands)
+    with dependency_lock:
+        dependency_results[key] = result
+    return result
+
+
+def check_dependencies_async(commands, callback, *user_data):
+    """Check for the required commands and sudo access in a worker thread.
+
+    callback(result, *user_data) is invoked from the GLib main loop once the
+    result is known. Concurrent requests for the same commands share a single
+    probe."""
+    key = tuple(commands)
+    with dependency_lock:
+        if key in dependency_results:
+            GLib.idle_add(dispatch_dependencies_callback, callback,
+                          dependency_results[key], user_data)
+            return
+        if key in dependency_callbacks:
+            dependency_callbacks[key].append((callback, user_data))
+            return
+        dependency_callbacks[key] = [(callback, user_data)]
+
+    def worker():
+        result = check_dependencies(commands)
+        with dependency_lock:
+            callbacks = dependency_callbacks.pop(key, [])
+        for pending_callback, pending_data in callbacks:
+            GLib.idle_add(dispatch_dependencies_callback, pending_callback,
+                          result, pending_data)
+
+    thread = threading.Thread(target=worker, name="mugshot-sudo-probe")
+    thread.daemon = True
+    thread.start()
+
+
+def dispatch_dependencies_callback(callback, result, user_data):
+    """Invoke a dependency callback once from the main loop."""
+    callback(result, *user_data)
+    return False
+
+
+def probe_dependencies(commands):
+    """Spawn sudo to check for the required commands and sudo access."""
     # Check for sudo
     if pexpect.which("sudo") is None:
         return False
@@ -81,12 +81,16 @@ class Window(Gtk.Window):
             logger.debug('show existing camera_dialog')
             self.camera_dialog.show()
         elif self.CameraDialog is not None:
-            logger.debug('create new camera_dialog')
-            self.camera_dialog = self.CameraDialog()  # pylint: disable=E1102
-            self.camera_dialog.connect(
-                'apply', self.on_camera_dialog_apply)  # pylint: disable=E1101
+            self.create_camera_dialog()
             self.camera_dialog.show()
 
+    def create_camera_dialog(self):
+        """Create the camera dialog without showing it."""
+        logger.debug('create new camera_dialog')
+        self.camera_dialog = self.CameraDialog()  # pylint: disable=E1102
+        self.camera_dialog.connect(
+            'apply', self.on_camera_dialog_apply)  # pylint: disable=E1101
+
     def on_destroy(self, widget, data=None):
         """Called when the MugshotWindow is closed."""
         # Clean up code for saving application state should be added here.
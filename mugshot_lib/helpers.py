@@ -17,14 +17,22 @@
 #   with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 """Helpers for an Ubuntu application."""
+import fcntl
+import hashlib
 import logging
 import os
+import shutil
 
 import tempfile
+from collections import OrderedDict
+
+from gi.repository import GdkPixbuf, GLib  # pylint: disable=E0611
 
 from . mugshotconfig import get_data_file
 from . Builder import Builder
 
+logger = logging.getLogger('mugshot_lib')
+
 
 def get_builder(builder_file_name):
     """Return a fully-instantiated Gtk.Builder instance from specified ui
@@ -53,6 +61,72 @@ def get_media_file(media_file_name):
     return "file:///" + media_filename
 
 
+def get_scaled_pixbuf(filename, width, height):
+    """Load an image scaled to width x height, or return None if the file
+    cannot be loaded.
+
+    The image is decoded directly at the requested size, so the loader can
+    downscale while decoding (e.g. in the DCT domain for JPEG) and the full
+    resolution image is never held in memory."""
+    try:
+        return GdkPixbuf.Pixbuf.new_from_file_at_scale(filename, width,
+                                                       height, False)
+    except GLib.Error:  # pylint: disable=E0712
+        return None
+
+
+class PixbufCache:
+
+    """Least recently used cache of decoded images.
+
+    Entries are keyed by filename, modification time, file size and the
+    requested decode size, so a file that changes on disk is decoded again.
+    The cache is bounded by both the number of entries and the total size of
+    the decoded pixels."""
+
+    def __init__(self, max_entries=4, max_bytes=256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def get(self, filename, size=None):
+        """Return the decoded image, or None if it cannot be loaded. If size
+        is specified, the image is decoded to fit within size x size."""
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        key = (filename, stat.st_mtime_ns, stat.st_size, size)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        try:
+            if size is None:
+                pixbuf = GdkPixbuf.Pixbuf.new_from_file(filename)
+            else:
+                pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_scale(
+                    filename, size, size, True)
+        except GLib.Error:  # pylint: disable=E0712
+            return None
+
+        byte_length = pixbuf.get_byte_length()
+        if byte_length <= self.max_bytes:
+            self.entries[key] = pixbuf
+            self.size += byte_length
+            while len(self.entries) > self.max_entries or \
+                    self.size > self.max_bytes:
+                evicted = self.entries.popitem(last=False)[1]
+                self.size -= evicted.get_byte_length()
+        return pixbuf
+
+    def clear(self):
+        """Release every cached image."""
+        self.entries.clear()
+        self.size = 0
+
+
 class NullHandler(logging.Handler):
 
     """Handle NULL"""
@@ -142,3 +216,226 @@ def clear_tempfiles():
     """Remove all temporary files registered to Mugshot."""
     for identifier in list(temporary_files.keys()):
         remove_tempfile(identifier)
+
+
+# = Video Devices ======================================================== #
+video4linux_dir = '/sys/class/video4linux'
+udev_data_dir = '/run/udev/data'
+
+# The sysfs entries and devices found by the last get_video_devices call.
+video_devices = (None, [])
+
+
+def is_video_capture_device(entry):
+    """Return True if the video4linux sysfs entry is a video capture node.
+
+    The capabilities probed by udev are used when available. Otherwise only
+    the first node of each device is used, as the others are usually
+    metadata nodes."""
+    path = os.path.join(video4linux_dir, entry)
+    try:
+        with open(os.path.join(path, 'dev'), 'r') as dev:
+            udev_data = os.path.join(udev_data_dir, 'c' + dev.read().strip())
+        with open(udev_data, 'r') as data:
+            for line in data:
+                if line.startswith('E:ID_V4L_CAPABILITIES='):
+                    return ':capture:' in line
+    except OSError:
+        pass
+    try:
+        with open(os.path.join(path, 'index'), 'r') as index:
+            return index.read().strip() == '0'
+    except OSError:
+        return True
+
+
+def get_video_devices():
+    """Return the (device node, name) of every video capture device.
+
+    Devices are read from sysfs without opening them, and the list is
+    cached until a device is added or removed."""
+    global video_devices
+    try:
+        entries = sorted([entry for entry in os.listdir(video4linux_dir)
+                          if entry.startswith('video')],
+                         key=lambda entry: int(entry[5:] or 0))
+    except (OSError, ValueError):
+        return []
+    if video_devices[0] == entries:
+        return video_devices[1]
+
+    devices = []
+    for entry in entries:
+        if not is_video_capture_device(entry):
+            continue
+        try:
+            with open(os.path.join(video4linux_dir, entry, 'name'), 'r') \
+                    as name:
+                device_name = name.read().strip()
+        except OSError:
+            device_name = entry
+        devices.append(('/dev/' + entry, device_name))
+    logger.debug('Video capture devices: %s' %
+                 ', '.join(node for node, name in devices))
+    video_devices = (entries, devices)
+    return devices
+
+
+# = Atomic File Installation ============================================= #
+# ioctl request to clone (reflink) a whole file on btrfs, xfs and others.
+FICLONE = 0x40049409
+
+
+def get_file_mode():
+    """Return the permissions for new files, honoring the umask."""
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+def install_file(source, target):
+    """Atomically replace target with a copy of source.
+
+    The data is written to a temporary file beside target, flushed to disk
+    and renamed over target, so target is never missing or partial. The copy
+    is a reflink or an in-kernel copy when the filesystem supports it."""
+    with open(source, 'rb') as source_file:
+        install_with(target, lambda target_file:
+                     copy_file_data(source_file, target_file))
+
+
+def install_data(data, target):
+    """Atomically replace target with the bytes in data."""
+    install_with(target, lambda target_file: target_file.write(data))
+
+
+def install_with(target, write):
+    """Atomically replace target with the contents written by
+    write(file_object)."""
+    directory = os.path.dirname(os.path.abspath(target))
+    handle, temporary_filename = tempfile.mkstemp(
+        prefix='.%s.' % os.path.basename(target), dir=directory)
+    try:
+        with os.fdopen(handle, 'wb') as target_file:
+            write(target_file)
+            target_file.flush()
+            os.fsync(target_file.fileno())
+        os.chmod(temporary_filename, get_file_mode())
+        os.rename(temporary_filename, target)
+    except:
+        if os.path.isfile(temporary_filename):
+            os.remove(temporary_filename)
+        raise
+
+    # Make the rename itself durable.
+    directory_handle = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(directory_handle)
+    finally:
+        os.close(directory_handle)
+
+
+def copy_file_data(source_file, target_file):
+    """Copy the contents of one open file to another, preferring a reflink,
+    then copy_file_range, then a userspace copy."""
+    try:
+        fcntl.ioctl(target_file.fileno(), FICLONE, source_file.fileno())
+        return
+    except OSError:
+        pass
+
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while os.copy_file_range(source_file.fileno(),
+                                     target_file.fileno(), 1024 * 1024) > 0:
+                pass
+            return
+        except OSError:
+            # Rewind anything copied before the failure.
+            source_file.seek(0)
+            target_file.seek(0)
+            target_file.truncate()
+
+    shutil.copyfileobj(source_file, target_file)
+
+
+# = Thumbnail Cache ====================================================== #
+# Thumbnails are shared with other applications following the
+# freedesktop.org Thumbnail Managing Standard.
+thumbnail_size = 128
+
+
+def get_thumbnail_filename(uri):
+    """Return the normal size thumbnail filename for the specified URI."""
+    data = uri.encode('utf-8')
+    try:
+        # The digest is only a name, so allow it on FIPS-enabled systems.
+        digest = hashlib.md5(data, usedforsecurity=False).hexdigest()
+    except TypeError:
+        digest = hashlib.md5(data).hexdigest()
+    return os.path.join(GLib.get_user_cache_dir(), 'thumbnails', 'normal',
+                        '%s.png' % digest)
+
+
+def get_thumbnail_pixbuf(filename, width, height):
+    """Load an image scaled to width x height from the shared thumbnail
+    cache, creating the thumbnail if it is missing or outdated. Return None
+    if the file cannot be loaded."""
+    try:
+        mtime = str(int(os.stat(filename).st_mtime))
+    except OSError:
+        return None
+    uri = GLib.filename_to_uri(os.path.abspath(filename), None)
+    thumbnail_filename = get_thumbnail_filename(uri)
+
+    try:
+        thumbnail = GdkPixbuf.Pixbuf.new_from_file(thumbnail_filename)
+        if thumbnail.get_option('tEXt::Thumb::URI') != uri or \
+                thumbnail.get_option('tEXt::Thumb::MTime') != mtime:
+            thumbnail = None
+    except GLib.Error:  # pylint: disable=E0712
+        thumbnail = None
+
+    if thumbnail is None:
+        thumbnail = new_thumbnail(filename, uri, mtime, thumbnail_filename)
+        if thumbnail is None:
+            return None
+
+    if thumbnail.get_width() == width and thumbnail.get_height() == height:
+        return thumbnail
+    return thumbnail.scale_simple(width, height, GdkPixbuf.InterpType.HYPER)
+
+
+def new_thumbnail(filename, uri, mtime, thumbnail_filename):
+    """Create and store a normal size thumbnail, returning its pixbuf."""
+    try:
+        file_format, width, height = GdkPixbuf.Pixbuf.get_file_info(filename)
+        if file_format is None:
+            return None
+        if width <= thumbnail_size and height <= thumbnail_size:
+            thumbnail = GdkPixbuf.Pixbuf.new_from_file(filename)
+        else:
+            thumbnail = GdkPixbuf.Pixbuf.new_from_file_at_scale(
+                filename, thumbnail_size, thumbnail_size, True)
+    except GLib.Error:  # pylint: disable=E0712
+        return None
+
+    # Write to a temporary file first so other readers never see a partial
+    # thumbnail.
+    temporary_filename = None
+    try:
+        directory = os.path.dirname(thumbnail_filename)
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        handle, temporary_filename = tempfile.mkstemp(suffix='.png',
+                                                      dir=directory)
+        os.close(handle)
+        thumbnail.savev(temporary_filename, 'png',
+                        ['tEXt::Thumb::URI', 'tEXt::Thumb::MTime',
+                         'tEXt::Software'],
+                        [uri, mtime, 'Mugshot'])
+        os.rename(temporary_filename, thumbnail_filename)
+    except (OSError, GLib.Error):  # pylint: disable=E0712
+        logger.debug('Unable to write thumbnail for %s' % uri)
+        if temporary_filename and os.path.isfile(temporary_filename):
+            os.remove(temporary_filename)
+    return thumbnail
@@ -0,0 +1,402 @@
+#!/usr/bin/python3
+# -*- Mode: Python; coding: utf-8; indent-tabs-mode: nil; tab-width: 4 -*-
+#   Mugshot - Lightweight user configuration utility
+#   Copyright (C) 2013-2019 Sean Davis <sean@bluesabre.org>
+#
+#   This program is free software: you can redistribute it and/or modify it
+#   under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful, but
+#   WITHOUT ANY WARRANTY; without even the implied warranties of
+#   MERCHANTABILITY, SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR
+#   PURPOSE.  See the GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License along
+#   with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Crop geometry, masking and output shared by the file chooser and the
+camera.
+
+Crop rectangles are (x, y, width, height) tuples computed by pure functions.
+Circle masks are applied to the pixbuf pixel buffers with NumPy when it is
+available, falling back to cairo otherwise. Images travel from their source
+to ~/.face as ImageHandle objects."""
+
+import logging
+import math
+import os
+
+from gi.repository import Gdk, GdkPixbuf, GLib  # pylint: disable=E0611
+import cairo
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from . helpers import get_scaled_pixbuf, install_data, install_file
+
+logger = logging.getLogger('mugshot_lib')
+
+CROP_CENTER = 'center'
+CROP_LEFT = 'left'
+CROP_RIGHT = 'right'
+CROP_MANUAL = 'manual'
+
+
+# = Geometry ============================================================= #
+def get_zoom_range(width, height):
+    """Return the maximum zoom value for an image of the given size."""
+    return min(width, height)
+
+
+def get_manual_crop_range(width, height, zoom=0):
+    """Return the maximum (x, y) offsets for a manual crop."""
+    width = width - zoom
+    height = height - zoom
+    if width > height:
+        return (width - height + zoom, zoom)
+    return (zoom, height - width + zoom)
+
+
+def get_crop_rectangle(width, height, mode=CROP_CENTER, zoom=0, x=0, y=0):
+    """Return the square crop rectangle of an image of the given size.
+
+    zoom is the number of pixels trimmed from the shorter edge. x and y are
+    only used for manual crops. The result is rounded to whole pixels and
+    clamped to the image."""
+    source_width = width
+    source_height = height
+
+    # Minus height or width with the zoom value.
+    width = width - zoom
+    height = height - zoom
+    size = min(width, height)
+
+    # Start with the crop area centered on the zoomed picture.
+    start_x = zoom / 2
+    start_y = zoom / 2
+
+    if mode == CROP_CENTER:
+        start_x += (width - size) / 2
+        start_y += (height - size) / 2
+    elif mode == CROP_LEFT:
+        start_x = 0
+        start_y += (height - size) / 2
+    elif mode == CROP_RIGHT:
+        start_x = source_width - size
+        start_y += (height - size) / 2
+    elif mode == CROP_MANUAL:
+        start_x = x
+        start_y = y
+
+    return clamp_crop_rectangle((start_x, start_y, size, size),
+                                source_width, source_height)
+
+
+def clamp_crop_rectangle(crop, width, height):
+    """Return the crop rectangle rounded to whole pixels and clamped to an
+    image with the specified dimensions."""
+    crop_width = max(1, min(int(round(crop[2])), width))
+    crop_height = max(1, min(int(round(crop[3])), height))
+    x = max(0, min(int(round(crop[0])), width - crop_width))
+    y = max(0, min(int(round(crop[1])), height - crop_height))
+    return (x, y, crop_width, crop_height)
+
+
+def scale_crop_rectangle(crop, scale, width, height):
+    """Map a crop rectangle onto an image scaled by the specified factor, with
+    the specified (scaled) dimensions."""
+    return clamp_crop_rectangle([value * scale for value in crop],
+                                width, height)
+
+
+# = Pixel Buffers ======================================================== #
+def get_pixel_array(pixbuf):
+    """Return a (height, width, channels) array copy of the pixbuf pixels."""
+    width = pixbuf.get_width()
+    height = pixbuf.get_height()
+    channels = pixbuf.get_n_channels()
+    rowstride = pixbuf.get_rowstride()
+    pixels = numpy.frombuffer(pixbuf.get_pixels(), dtype=numpy.uint8)
+    # The last row is not padded to the rowstride.
+    array = numpy.lib.stride_tricks.as_strided(
+        pixels, shape=(height, width, channels),
+        strides=(rowstride, channels, 1), writeable=False)
+    return numpy.ascontiguousarray(array)
+
+
+def new_pixbuf_from_array(array):
+    """Create a pixbuf from a (height, width, channels) uint8 array."""
+    height, width, channels = array.shape
+    data = GLib.Bytes.new(numpy.ascontiguousarray(array).tobytes())
+    return GdkPixbuf.Pixbuf.new_from_bytes(data, GdkPixbuf.Colorspace.RGB,
+                                           channels == 4, 8, width, height,
+                                           width * channels)
+
+
+def get_circle_mask(width, height):
+    """Return an anti-aliased float32 circle alpha mask, scaled from 0.0 to
+    1.0. All arithmetic is done in place on a single (height, width)
+    array."""
+    radius = min(width, height) / 2
+    x = numpy.arange(width, dtype=numpy.float32) + (0.5 - width / 2)
+    y = numpy.arange(height, dtype=numpy.float32)[:, None] + \
+        (0.5 - height / 2)
+    mask = x * x + y * y
+    numpy.sqrt(mask, out=mask)
+    numpy.subtract(radius + 0.5, mask, out=mask)
+    return numpy.clip(mask, 0.0, 1.0, out=mask)
+
+
+def apply_circle_mask(arrays):
+    """Mask an (n, height, width, channels) array of frames to a circle,
+    returning an (n, height, width, 4) array."""
+    count, height, width, channels = arrays.shape
+    if channels == 3:
+        alpha = numpy.full((count, height, width, 1), 255, numpy.uint8)
+        arrays = numpy.concatenate((arrays, alpha), axis=3)
+    else:
+        arrays = arrays.copy()
+    # Scale only the alpha channel, in place, without a float copy of it.
+    alpha = arrays[..., 3]
+    numpy.multiply(alpha, get_circle_mask(width, height), out=alpha,
+                   casting='unsafe')
+    return arrays
+
+
+def crop_circle_cairo(pixbuf):
+    """Mask a pixbuf to a circle with cairo."""
+    width = pixbuf.get_width()
+    height = pixbuf.get_height()
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+    context = cairo.Context(surface)
+
+    context.arc(width / 2, height / 2, min(width, height) / 2, 0,
+                2 * math.pi)
+    context.clip()
+    context.new_path()
+
+    Gdk.cairo_set_source_pixbuf(context, pixbuf, 0, 0)
+    context.paint()
+
+    return Gdk.pixbuf_get_from_surface(surface, 0, 0, width, height)
+
+
+# = Cropping ============================================================= #
+def crop_pixbuf(pixbuf, crop, circle=False):
+    """Return the crop rectangle of pixbuf, optionally masked to a circle."""
+    return crop_pixbufs([pixbuf], crop, circle)[0]
+
+
+def crop_pixbufs(pixbufs, crop, circle=False):
+    """Crop a batch of equally sized frames to the same rectangle.
+
+    Square crops are views into the source pixbufs. Circle crops mask every
+    frame in a single vectorized operation when NumPy is available."""
+    x, y, width, height = crop
+    cropped = [pixbuf.new_subpixbuf(x, y, width, height)
+               for pixbuf in pixbufs]
+    if not circle or len(cropped) == 0:
+        return cropped
+    if numpy is None:
+        return [crop_circle_cairo(pixbuf) for pixbuf in cropped]
+
+    arrays = numpy.stack([get_pixel_array(pixbuf) for pixbuf in cropped])
+    masked = apply_circle_mask(arrays)
+    return [new_pixbuf_from_array(array) for array in masked]
+
+
+def crop_files(filenames, mode=CROP_CENTER, zoom=0, circle=False):
+    """Crop a batch of image files, returning a list of pixbufs (or None for
+    files that cannot be loaded)."""
+    results = []
+    for filename in filenames:
+        try:
+            pixbuf = GdkPixbuf.Pixbuf.new_from_file(filename)
+        except GLib.Error:  # pylint: disable=E0712
+            logger.debug('Unable to load %s' % filename)
+            results.append(None)
+            continue
+        crop = get_crop_rectangle(pixbuf.get_width(), pixbuf.get_height(),
+                                  mode, zoom)
+        results.append(crop_pixbuf(pixbuf, crop, circle))
+    return results
+
+
+# = Sharpness ============================================================ #
+def get_sharpness_scores(pixbufs, crop, size=160):
+    """Return the variance of the Laplacian of the crop rectangle of each of
+    a batch of equally sized frames. Higher scores are sharper.
+
+    The frames are scored on grayscale copies scaled to fit within size x
+    size, in a single vectorized operation. Requires NumPy."""
+    x, y, width, height = crop
+    scale = min(1.0, size / max(width, height))
+    scaled_width = max(3, int(round(width * scale)))
+    scaled_height = max(3, int(round(height * scale)))
+
+    frames = []
+    for pixbuf in pixbufs:
+        scaled = pixbuf.new_subpixbuf(x, y, width, height).scale_simple(
+            scaled_width, scaled_height, GdkPixbuf.InterpType.BILINEAR)
+        frames.append(get_pixel_array(scaled)[..., :3])
+    gray = numpy.stack(frames).astype(numpy.float32) @ \
+        numpy.array([0.299, 0.587, 0.114], numpy.float32)
+
+    laplacian = gray[:, :-2, 1:-1] + gray[:, 2:, 1:-1] + \
+        gray[:, 1:-1, :-2] + gray[:, 1:-1, 2:] - 4 * gray[:, 1:-1, 1:-1]
+    return laplacian.reshape(len(frames), -1).var(axis=1).tolist()
+
+
+def get_sharpest_pixbuf(pixbufs, crop):
+    """Return the frame whose crop rectangle is the sharpest, or the last
+    frame if NumPy is not available."""
+    if numpy is None or len(pixbufs) == 1:
+        return pixbufs[-1]
+    scores = get_sharpness_scores(pixbufs, crop)
+    logger.debug('Sharpness scores: %s' %
+                 ', '.join('%.1f' % score for score in scores))
+    return pixbufs[scores.index(max(scores))]
+
+
+# = Output =============================================================== #
+def normalize_image(source, target, max_size=512, image_format='png',
+                    compression=9, quality=90):
+    """Write source to target scaled to fit within max_size and encoded as
+    image_format. Return False without writing anything if source is already
+    a small enough image in the requested format, or cannot be loaded."""
+    file_format, width, height = GdkPixbuf.Pixbuf.get_file_info(source)
+    if file_format is None:
+        return False
+    if file_format.get_name() == image_format and \
+            max(width, height) <= max_size:
+        return False
+
+    try:
+        if max(width, height) > max_size:
+            pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_scale(
+                source, max_size, max_size, True)
+        else:
+            pixbuf = GdkPixbuf.Pixbuf.new_from_file(source)
+    except GLib.Error:  # pylint: disable=E0712
+        return False
+
+    save_pixbuf(pixbuf, target, image_format, compression, quality)
+    return True
+
+
+def encode_pixbuf(pixbuf, image_format='png', compression=9, quality=90):
+    """Encode pixbuf as a PNG or JPEG image, returning the bytes."""
+    if image_format == 'jpeg' and pixbuf.get_has_alpha():
+        # JPEG cannot store transparency, such as from circle crops.
+        image_format = 'png'
+    if image_format == 'jpeg':
+        success, data = pixbuf.save_to_bufferv('jpeg', ['quality'],
+                                               [str(quality)])
+    else:
+        success, data = pixbuf.save_to_bufferv('png', ['compression'],
+                                               [str(compression)])
+    return data
+
+
+def save_pixbuf(pixbuf, target, image_format='png', compression=9,
+                quality=90):
+    """Atomically save pixbuf to target as a PNG or JPEG image."""
+    install_data(encode_pixbuf(pixbuf, image_format, compression, quality),
+                 target)
+
+
+# = Image Handles ======================================================== #
+class ImageHandle:
+
+    """A profile image passed from an image source to the save path.
+
+    Carries the source filename, the decoded pixbuf and the encoded bytes,
+    so the image is decoded and encoded at most once however many times it
+    is previewed or saved. Cropped images only exist as a pixbuf, stock and
+    existing images only as a filename. A handle with neither removes the
+    profile image."""
+
+    def __init__(self, filename=None, pixbuf=None):
+        self.filename = filename
+        self.pixbuf = pixbuf
+        self.data = None
+        self.data_options = None
+        self.scaled = {}
+
+    def is_empty(self):
+        """Return True if the handle removes the profile image."""
+        return self.filename is None and self.pixbuf is None
+
+    def get_filename(self):
+        """Return the source filename, or None for in-memory images."""
+        return self.filename
+
+    def get_pixbuf(self):
+        """Return the full resolution image, decoding it on first use."""
+        if self.pixbuf is None and self.filename is not None:
+            try:
+                self.pixbuf = GdkPixbuf.Pixbuf.new_from_file(self.filename)
+            except GLib.Error:  # pylint: disable=E0712
+                logger.debug('Unable to load %s' % self.filename)
+        return self.pixbuf
+
+    def get_scaled_pixbuf(self, width, height):
+        """Return the image scaled to width x height, or None if it cannot be
+        loaded. Files are decoded directly at the requested size."""
+        key = (width, height)
+        if key not in self.scaled:
+            if self.pixbuf is not None:
+                self.scaled[key] = self.pixbuf.scale_simple(
+                    width, height, GdkPixbuf.InterpType.HYPER)
+            elif self.filename is not None:
+                self.scaled[key] = get_scaled_pixbuf(self.filename, width,
+                                                     height)
+            else:
+                self.scaled[key] = None
+        return self.scaled[key]
+
+    def get_data(self, max_size=512, image_format='png', compression=9,
+                 quality=90):
+        """Return the image scaled to fit within max_size and encoded as
+        image_format. The bytes are kept for later calls with the same
+        options."""
+        options = (max_size, image_format, compression, quality)
+        if self.data is None or self.data_options != options:
+            pixbuf = self.get_pixbuf()
+            if pixbuf is None:
+                return None
+            width = pixbuf.get_width()
+            height = pixbuf.get_height()
+            if max(width, height) > max_size:
+                scale = max_size / max(width, height)
+                pixbuf = pixbuf.scale_simple(
+                    max(1, int(round(width * scale))),
+                    max(1, int(round(height * scale))),
+                    GdkPixbuf.InterpType.HYPER)
+            self.data = encode_pixbuf(pixbuf, image_format, compression,
+                                      quality)
+            self.data_options = options
+        return self.data
+
+    def install(self, target, max_size=512, image_format='png',
+                compression=9, quality=90):
+        """Atomically write the image to target, scaled to fit within
+        max_size. Return False if the image cannot be loaded."""
+        if self.pixbuf is None and self.filename is not None:
+            # Copy files that are already suitable without decoding them.
+            if not normalize_image(self.filename, target, max_size,
+                                   image_format, compression, quality):
+                if not os.path.isfile(self.filename):
+                    return False
+                install_file(self.filename, target)
+            return True
+
+        data = self.get_data(max_size, image_format, compression, quality)
+        if data is None:
+            return False
+        install_data(data, target)
+        return True